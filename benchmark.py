@@ -0,0 +1,304 @@
+#!/usr/bin/python3
+
+# Copyright 2017-2018 Motylenok Mikhail
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# FASTBUILD BENCHMARK - measures overhead of fastbuild itself on synthetic projects
+
+# Generates synthetic C++ project (sources in macrotarget directories, headers in
+# layers, every layer includes headers of the next one), builds it with a stub
+# compiler which only creates output files, and measures phases:
+#   cold        - first build without build state (scan, hash, compile all)
+#   noop        - build without any changes (without trace, it takes the null build fast path)
+#   touch       - build after change of one header of the middle layer
+#   rebuildall  - build with -a
+# Results are written in JSON, and can be compared with results of other version.
+
+from subprocess import Popen, PIPE
+import argparse
+import sys
+import os
+import json
+import time
+import random
+import shutil
+import platform
+import tempfile
+
+stubCompiler = """#!/bin/sh
+# stub compiler of fastbuild benchmark: creates output and dependency files only
+out=""
+dep=""
+prev=""
+for arg in "$@"; do
+    case "$prev" in
+        -o) out="$arg" ;;
+        -MF) dep="$arg" ;;
+    esac
+    prev="$arg"
+done
+if [ "$1" = "--version" ]; then
+    echo "stubcc 1.0"
+    exit 0
+fi
+if [ -n "$out" ]; then
+    : > "$out"
+fi
+if [ -n "$dep" ]; then
+    echo "$out:" > "$dep"
+fi
+exit 0
+"""
+
+
+def backdate(path):
+    """Sets modification time of file a minute back: fastbuild does not write the null build 
+    manifest when sources were modified just before the build, so noop would not measure it
+    """
+    past = time.time() - 60
+    os.utime(path, (past, past))
+
+
+def generateProject(root, args):
+    """Generates synthetic project in root directory and returns list of
+    headers of the middle layer (candidates for touch phase)
+    """
+    rnd = random.Random(args.seed)
+
+    layers = list()
+    perLayer = max(1, args.headers // max(1, args.depth))
+    for layer in range(args.depth):
+        layers.append(["inc/l" + str(layer) + "/h" + str(i) + ".h" for i in range(perLayer)])
+
+    for layer in range(args.depth):
+        os.makedirs(os.path.join(root, "inc", "l" + str(layer)))
+        for header in layers[layer]:
+            lines = ["#pragma once"]
+            if layer + 1 < args.depth:
+                for included in rnd.sample(layers[layer + 1], min(args.header_fanout, len(layers[layer + 1]))):
+                    lines.append("#include \"../l" + str(layer + 1) + "/" + os.path.basename(included) + "\"")
+            lines.append("int " + header.replace("/", "_").replace(".", "_") + "(void);")
+            f = open(os.path.join(root, header), "w")
+            f.write("\n".join(lines) + "\n")
+            f.close()
+
+    for mt in range(args.macrotargets):
+        os.makedirs(os.path.join(root, "mod" + str(mt)))
+    for i in range(args.sources):
+        mt = i % args.macrotargets
+        lines = list()
+        for included in rnd.sample(layers[0], min(args.source_fanout, len(layers[0]))):
+            lines.append("#include \"../" + included + "\"")
+        lines.append("int s" + str(i) + "(void) { return " + str(i) + "; }")
+        f = open(os.path.join(root, "mod" + str(mt), "s" + str(i) + ".cpp"), "w")
+        f.write("\n".join(lines) + "\n")
+        f.close()
+
+    os.makedirs(os.path.join(root, "build"))
+    stub = os.path.join(root, "build", "stubcc")
+    f = open(stub, "w")
+    f.write(stubCompiler)
+    f.close()
+    os.chmod(stub, 0o755)
+
+    macrotargets = dict()
+    for mt in range(args.macrotargets):
+        macrotargets.update({"mod" + str(mt) : ["../mod" + str(mt) + "/*.cpp"]})
+
+    config = {
+        "compiler" : stub,
+        "compiler_params" : "",
+        "linker_params" : "",
+        "targets_build_path" : "",
+        "linker_output_file" : "app",
+        "postprocessing_shell" : "",
+        "postprocessing_if_failed" : False,
+        "untracked_action" : "accept",
+        "sources_endings" : [".cpp"],
+        "headers_endings" : [".h"],
+        "macrotargets" : macrotargets
+    }
+    if args.pipeline:
+        config.update({"pipeline" : True})
+    f = open(os.path.join(root, "build", "fastbuild.json"), "w")
+    json.dump(config, f, indent=4)
+    f.close()
+
+    f = open(os.path.join(root, ".gitignore"), "w")
+    f.write("build/fastbuild/\nbuild/app\n")
+    f.close()
+
+    for (dirpath, dirnames, filenames) in os.walk(root):
+        for filename in filenames:
+            backdate(os.path.join(dirpath, filename))
+
+    for command in ["git init -q .", "git add -A",
+        "git -c user.name=bench -c user.email=bench@localhost commit -q -m synthetic"]:
+        Popen(command, shell=True, cwd=root).wait()
+
+    return layers[args.depth // 2]
+
+
+def supportsTrace(fastbuild):
+    """Checks if tested fastbuild version can write trace (--trace)"""
+    child = Popen([sys.executable, fastbuild, "--help"], stdout=PIPE, stderr=PIPE)
+    output = child.communicate()[0]
+    return b"--trace" in output
+
+
+def runFastbuild(fastbuild, builddir, extra, traceFile):
+    """Runs fastbuild in build directory, returns wall time and durations of its steps"""
+    command = [sys.executable, fastbuild, "-q"] + extra
+    if traceFile != None:
+        command = command + ["--trace", traceFile]
+
+    start = time.time()
+    child = Popen(command, cwd=builddir, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+    (output, errors) = child.communicate(b"\n" * 4)
+    wall = time.time() - start
+    if child.returncode != 0:
+        sys.exit("fastbuild failed:\n" + errors.decode("utf-8", "replace"))
+
+    steps = dict()
+    if traceFile != None:
+        for event in json.load(open(traceFile, "r"))["traceEvents"]:
+            if event.get("cat") == "step":
+                steps.update({event["name"] : steps.get(event["name"], 0.0) + event["dur"] / 1000000.0})
+    return wall, steps
+
+
+def median(values):
+    """Returns median of the list of values"""
+    ordered = sorted(values)
+    middle = len(ordered) // 2
+    if len(ordered) % 2 == 1:
+        return ordered[middle]
+    return (ordered[middle - 1] + ordered[middle]) / 2.0
+
+
+def summarize(runs):
+    """Makes result of phase from its runs: median wall time and median of every step"""
+    result = {"median" : round(median([wall for (wall, steps) in runs]), 4),
+        "runs" : [round(wall, 4) for (wall, steps) in runs], "steps" : dict()}
+    names = list()
+    for (wall, steps) in runs:
+        for name in steps:
+            if name not in names:
+                names.append(name)
+    for name in names:
+        result["steps"].update({name : round(median([steps.get(name, 0.0) for (wall, steps) in runs]), 4)})
+    return result
+
+
+def runBenchmark(args):
+    """Generates project, measures all phases and returns results"""
+    root = tempfile.mkdtemp(prefix="fastbuild-bench-")
+    try:
+        touchable = generateProject(root, args)
+        builddir = os.path.join(root, "build")
+        extra = ["-p", str(args.threads)]
+
+        traceFile = None
+        if supportsTrace(args.fastbuild):
+            traceFile = os.path.join(root, "trace.json")
+
+        phases = {"cold" : list(), "noop" : list(), "touch" : list(), "rebuildall" : list()}
+        for rep in range(args.repeat):
+            shutil.rmtree(os.path.join(builddir, "fastbuild"), ignore_errors=True)
+            phases["cold"].append(runFastbuild(args.fastbuild, builddir, extra, traceFile))
+            #without trace, so the null build fast path of fastbuild is measured
+            phases["noop"].append(runFastbuild(args.fastbuild, builddir, extra, None))
+
+            header = os.path.join(root, touchable[rep % len(touchable)])
+            f = open(header, "a")
+            f.write("// touched " + str(rep) + "\n")
+            f.close()
+            backdate(header)
+            phases["touch"].append(runFastbuild(args.fastbuild, builddir, extra, traceFile))
+
+            phases["rebuildall"].append(runFastbuild(args.fastbuild, builddir, extra + ["-a"], traceFile))
+
+        child = Popen([sys.executable, args.fastbuild, "-v"], stdout=PIPE, stderr=PIPE)
+        version = child.communicate()[1].decode("utf-8", "replace").strip()
+
+        results = {
+            "fastbuild" : os.path.abspath(args.fastbuild),
+            "version" : version,
+            "python" : platform.python_version(),
+            "platform" : platform.platform(),
+            "date" : int(time.time()),
+            "project" : {"sources" : args.sources, "headers" : args.headers, "depth" : args.depth,
+                "source_fanout" : args.source_fanout, "header_fanout" : args.header_fanout,
+                "macrotargets" : args.macrotargets, "seed" : args.seed, "pipeline" : args.pipeline},
+            "threads" : args.threads,
+            "repeat" : args.repeat,
+            "phases" : dict()
+        }
+        for phase in phases:
+            results["phases"].update({phase : summarize(phases[phase])})
+        return results
+    finally:
+        if args.keep:
+            print("Project kept in " + root)
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+
+
+def printResults(results, baseline):
+    """Prints medians of phases, and ratio to baseline results if they are given"""
+    print(results["version"] + ", " + str(results["project"]["sources"]) + " sources, "
+        + str(results["project"]["headers"]) + " headers, " + str(results["threads"]) + " threads")
+    for phase in results["phases"]:
+        line = "  " + phase.ljust(12) + str(round(results["phases"][phase]["median"], 3)).rjust(9) + " s"
+        if (baseline != None) and (phase in baseline["phases"]) and (baseline["phases"][phase]["median"] > 0):
+            ratio = results["phases"][phase]["median"] / baseline["phases"][phase]["median"]
+            line = line + "   x" + str(round(ratio, 2)) + " of baseline (" + str(round(baseline["phases"][phase]["median"], 3)) + " s)"
+        print(line)
+        for step in results["phases"][phase]["steps"]:
+            print("      " + step.ljust(36) + str(round(results["phases"][phase]["steps"][step], 3)).rjust(9) + " s")
+
+
+if  __name__ ==  "__main__" :
+    parser = argparse.ArgumentParser(description="Measures overhead of fastbuild on synthetic project with stub compiler")
+    parser.add_argument("--fastbuild", help="fastbuild script to measure (default: fastbuild.py near this script)",
+        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "fastbuild.py"))
+    parser.add_argument("--sources", help="Number of sources (default: 500)", type=int, default=500)
+    parser.add_argument("--headers", help="Number of headers (default: 200)", type=int, default=200)
+    parser.add_argument("--depth", help="Number of header layers, include depth (default: 4)", type=int, default=4)
+    parser.add_argument("--source-fanout", help="Headers included by every source (default: 8)", type=int, default=8)
+    parser.add_argument("--header-fanout", help="Headers of next layer included by every header (default: 3)", type=int, default=3)
+    parser.add_argument("--macrotargets", help="Number of macrotargets (default: 4)", type=int, default=4)
+    parser.add_argument("--seed", help="Seed of project generator (default: 1)", type=int, default=1)
+    parser.add_argument("--pipeline", help="Build in pipelined mode (\"pipeline\" in config)", action="store_true")
+    parser.add_argument("-p", "--threads", help="Threads of fastbuild (default: 1)", type=int, default=1)
+    parser.add_argument("--repeat", help="Number of runs of every phase (default: 3)", type=int, default=3)
+    parser.add_argument("-o", "--output", help="Write results to JSON file", type=str)
+    parser.add_argument("--compare", help="Compare with results in JSON file", type=str)
+    parser.add_argument("--keep", help="Keep generated project", action="store_true")
+    args = parser.parse_args()
+
+    if (args.sources < 1) or (args.headers < 1) or (args.depth < 1) or (args.macrotargets < 1) or (args.repeat < 1):
+        sys.exit("Numbers of sources, headers, layers, macrotargets and runs must be positive!")
+
+    baseline = None
+    if args.compare:
+        baseline = json.load(open(args.compare, "r"))
+
+    results = runBenchmark(args)
+    printResults(results, baseline)
+
+    if args.output:
+        f = open(args.output, "w")
+        json.dump(results, f, indent=4)
+        f.close()
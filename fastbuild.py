@@ -29,23 +29,36 @@
 #//"untracked_action" - default action to do with untracked files (vars: "ask", "accept", "ignore")
 #//"sources_endings" - what files to compile (most common: ".c", ".cpp")
 #//"headers_endings" - all endings of headers files in projects: (example: ".h", ".hpp")
+#//"compiler_dependencies" - use dependencies reported by compiler (-MMD) after first build (true/false)
+#//"hash_algorithm" - checksum algorithm for file contents (vars: "git", "md5", "sha1", "blake2b", "xxhash")
+#//"precompiled_headers" - build precompiled header of most included headers for every macrotarget (true/false)
+#//"pch_threshold" - part of sources of macrotarget which must include a header to put it in precompiled header (0.5)
+#//"pch_header" - use this header as precompiled header for all macrotargets instead of selected ones
+#//"unity_build" - compile sources of every macrotarget in generated batch files (true/false)
+#//"unity_batch_size" - maximum number of sources in one batch file (8)
+#//"memory_limit" - hold back new compiles while used memory is over this percent of RAM (90, 0 - off)
+#//"load_limit" - hold back new compiles while load average is over this value (0 - off)
+#//"workers" - list of remote compile workers: [{"address": "host:port" or "unix:/path", "slots": 4}]
+#//"cache_dir" - object cache directory shared by checkouts and concurrent builds
+#//"cache_size" - size limit of shared cache in MiB, least recently used objects are evicted (5120, 0 - off)
+#//"cache_compression" - compress objects in shared cache with zlib (true/false)
+#//"object_retention" - number of unused files kept in fastbuild/objects and fastbuild/pch (256, -1 - keep all)
+#//"prelink" - pre-link every macrotarget before final link (vars: "none", "archive", "relocatable")
 #//"macrotargets" - structure of pairs of macrotraget's name and array of 
 #//         filename strings. Each string must contain one file name or one 
 #//         correct regular expression for files. 
+#//         ** matches any number of directories, "!pattern" excludes files.
+#//         Macrotarget can be object {"sources": [...], "type": "static"/"shared"/"executable",
+#//         "output": "file", "depends": [macrotargets], "linker_params": "..."}, it is linked
+#//         into its own product instead of "linker_output_file".
 
 
-from subprocess import Popen, PIPE
-from subprocess import call
-import fnmatch
 import argparse
 import sys
 import os
 import json
-import pprint 
 import time
-import hashlib
-import threading
-import copy
+from array import array
 
 repositoryRoot = "."
 relativeToRoot = "."
@@ -55,11 +68,98 @@ configFileName = "fastbuild.json"
 treeOut = False
 recursionThreshold = 24
 systemEncoding = sys.stdout.encoding
-usedFasttreeFilenames = list()
+usedDependencyTrees = set()
 failmarker = False
 threadLimit = 1
 rebuildTree = False
 verstring = "fastbuild.py 1.2b"
+resolvedPathsCache = dict()
+rootPathsCache = dict()
+resolveCacheHits = 0
+resolveLookups = 0
+includesCache = dict()
+usedIncludesCache = dict()
+directIncludes = dict()
+dependencyClosures = dict()
+includesParsedCount = 0
+includesRestoredCount = 0
+closuresReusedCount = 0
+outdatedTreesCount = 0
+buildMetrics = dict({"compile" : dict(), "link" : dict()})
+buildMetricsLock = None
+metricsHistoryLength = 8
+jobCosts = dict()
+objectKeys = dict()
+objectKeyPrefix = ""
+compilerDependencies = False
+harvestedDependencies = dict()
+precompiledHeaders = dict()
+precompiledClosures = dict()
+precompiledKeys = dict()
+precompiledPlans = list()
+storeKeysInUse = set()
+unityBatches = dict()
+unityObjects = dict()
+admission = None
+traceFileName = None
+traceOrigin = time.time()
+traceEvents = list()
+traceLanes = dict()
+traceLock = None
+traceCurrentStep = None
+runningCompiles = 0
+remoteJobsHeld = 0
+scanStatsLock = None
+failureMode = "stop"
+buildCancelled = None
+runningChildren = set()
+runningChildrenLock = None
+printLock = None
+recentModificationWindow = 600
+sharedCache = None
+manifestFileName = "fastbuild/manifest.json"
+productTypes = dict({"static" : "libNAME.a", "shared" : "libNAME.so", "executable" : "NAME"})
+sourcesPending = None
+pipelineStopped = None
+workerCompilers = ["gcc", "g++", "cc", "c++", "clang", "clang++"]
+workerDeniedParams = ["-wrapper", "-fplugin", "-B", "-specs", "--specs", "-o", "-M", "-save-temps", "-dumpdir", 
+    "-dumpbase", "-aux-info", "-fdump-", "-fprofile-", "-include", "-imacros", "@"]
+workerCompilerVersions = dict()
+globCache = dict()
+usedGlobCache = dict()
+globCacheLock = None
+globCacheHits = 0
+globCacheMisses = 0
+watchMode = False
+buildContext = dict()
+hashAlgorithm = "git"
+gitStatusEntries = list()
+gitIndexBlobs = dict()
+gitDirtyPaths = set()
+gitBlobHits = 0
+fingerprints = dict()
+runChecksums = dict()
+fingerprintsLock = None
+fingerprintHits = 0
+fingerprintReads = 0
+buildProgress = dict({"done" : 0, "total" : 0, "estimatedDone" : 0.0, "start" : 0.0})
+stateDatabase = None
+stateSnapshot = dict()
+buildState = dict()
+dependencyTrees = dict()
+
+#tables of build state database: name -> (key column, value columns, values stored as json)
+stateTables = dict({
+    "meta" : ("name", ["value"], True),
+    "fingerprints" : ("path", ["size", "mtime", "inode", "checksum"], False),
+    "includes" : ("checksum", ["includes"], True),
+    "trees" : ("checksum", ["deps"], True),
+    "checksums" : ("path", ["checksum"], False),
+    "objects" : ("source", ["objkey"], False),
+    "metrics" : ("target", ["samples"], True),
+    "globs" : ("pattern", ["resolved"], True),
+    "blobs" : ("path", ["blob"], False),
+})
 
 
 class bgcolors:
@@ -78,6 +178,72 @@ class pregenerationError(Exception):
     def __init__(self, message):
         self.message = message
 
+class dependencyIndex:
+    """Dependency graph of the build. Paths are interned to integer ids, dependencies
+    of every source and the inverted index (dependency -> dependent sources) are kept
+    as compact arrays of ids, so finding sources affected by changed headers costs
+    proportionally to the answer, not to the number of edges in the graph.
+    """
+    def __init__(self):
+        self.paths = list()
+        self.ids = dict()
+        self.dependencies = dict()
+        self.dependents = dict()
+
+    def intern(self, path):
+        """Returns integer id of the path, adding it to the table if needed"""
+        pathId = self.ids.get(path)
+        if pathId == None:
+            pathId = len(self.paths)
+            self.paths.append(path)
+            self.ids.update({path : pathId})
+        return pathId
+
+    def addSource(self, source, deps):
+        """Sets dependencies (paths relative to repository root) of the source file"""
+        sourceId = self.intern(source)
+        self.removeSource(source)
+        depIds = array('I', [self.intern(dep) for dep in deps])
+        self.dependencies.update({sourceId : depIds})
+        for depId in depIds:
+            if depId not in self.dependents:
+                self.dependents.update({depId : array('I')})
+            self.dependents[depId].append(sourceId)
+
+    def removeSource(self, source):
+        """Removes the source file and its edges from the graph"""
+        sourceId = self.ids.get(source)
+        if (sourceId == None) or (sourceId not in self.dependencies):
+            return
+        for depId in self.dependencies[sourceId]:
+            self.dependents[depId].remove(sourceId)
+            if len(self.dependents[depId]) == 0:
+                del self.dependents[depId]
+        del self.dependencies[sourceId]
+
+    def dependenciesOf(self, source):
+        """Returns dependencies of the source file"""
+        sourceId = self.ids.get(source)
+        if (sourceId == None) or (sourceId not in self.dependencies):
+            return list()
+        return [self.paths[depId] for depId in self.dependencies[sourceId]]
+
+    def dependentsOf(self, dependency):
+        """Returns source files depending on the file (path relative to repository root)"""
+        depId = self.ids.get(dependency)
+        if (depId == None) or (depId not in self.dependents):
+            return list()
+        return [self.paths[sourceId] for sourceId in self.dependents[depId]]
+
+    def sourcePaths(self):
+        """Returns all source files of the graph"""
+        return [self.paths[sourceId] for sourceId in self.dependencies]
+
+    def dependencyPaths(self):
+        """Returns all files some source depends on, without duplicates"""
+        return [self.paths[depId] for depId in self.dependents]
+
+
 def fastprint(txt, level=0, fastend=None):
     """Function implements output operation.
     Level paramter allows to cut or verbose output strings.
@@ -92,53 +258,836 @@ def fastprint(txt, level=0, fastend=None):
         print(txt, end=fastend)
 
 
+def readStateTable(name):
+    """Reads table of the build state database into dictionary key -> value"""
+    (keyColumn, valueColumns, jsonValues) = stateTables[name]
+    table = dict()
+    for row in stateDatabase.execute("SELECT " + keyColumn + ", " + ", ".join(valueColumns) + " FROM " + name):
+        if len(valueColumns) > 1:
+            table.update({row[0] : list(row[1:])})
+        elif jsonValues:
+            table.update({row[0] : json.loads(row[1])})
+        else:
+            table.update({row[0] : row[1]})
+    return table
+
+
+def openBuildState():
+    """Opens build state database fastbuild/state.db (dependency trees, include cache, 
+    fingerprints, checksums, object keys, metrics) and loads it into memory once. 
+    State files of older fastbuild versions are migrated into the database.
+    """
+    import sqlite3
+
+    global stateDatabase
+    global stateSnapshot
+    global buildState
+    global rebuildall
+
+    if (not os.path.isdir("fastbuild")):
+        os.makedirs("fastbuild")
+
+    if stateDatabase != None:
+        stateDatabase.close()
+        stateDatabase = None
+
+    try:
+        stateDatabase = sqlite3.connect("fastbuild/state.db", check_same_thread=False)
+        for name in stateTables:
+            (keyColumn, valueColumns, jsonValues) = stateTables[name]
+            stateDatabase.execute("CREATE TABLE IF NOT EXISTS " + name + " (" + keyColumn + " TEXT PRIMARY KEY, " 
+                + ", ".join(valueColumns) + ") WITHOUT ROWID")
+        buildState = dict()
+        for name in stateTables:
+            buildState.update({name : readStateTable(name)})
+    except (sqlite3.DatabaseError, ValueError):
+        fastprint("Build state database fastbuild/state.db is damaged, it will be recreated.", level=2)
+        if stateDatabase != None:
+            stateDatabase.close()
+        os.remove("fastbuild/state.db")
+        return openBuildState()
+
+    stateSnapshot = dict()
+    for name in buildState:
+        stateSnapshot.update({name : dict(buildState[name])})
+
+    migrateLegacyState()
+    restoreBuildState()
+
+    ver = buildState["meta"].get("version", verstring)
+    if ver != verstring:
+        rebuildall = True
+        fastprint("Your repository generated by older or newer version of fastbuild. Rebuildall required.", level=1)
+    buildState["meta"].update({"version" : verstring})
+
+
+def restoreBuildState():
+    """Sets working structures of the build from loaded state tables"""
+    global dependencyTrees
+    dependencyTrees = buildState["trees"]
+    loadFingerprints()
+    loadIncludesCache()
+    loadBuildMetrics()
+    loadGlobCache()
+
+
+def migrateLegacyState():
+    """Imports state kept by older fastbuild versions in separate files (.fasttree 
+    trees, repository.md5, repversion.txt, json caches) into the build state 
+    database and removes those files, together with objects of the old layout.
+    """
+    import fnmatch
+
+    legacyFiles = list()
+
+    def readLegacyJson(filename, default):
+        try:
+            value = json.loads(open("fastbuild/" + filename, 'r').read())
+        except (IOError, ValueError):
+            return default
+        legacyFiles.append("fastbuild/" + filename)
+        return value
+
+    for entry in os.listdir("fastbuild"):
+        if fnmatch.fnmatch(entry, "*.fasttree"):
+            try:
+                buildState["trees"].update({entry[:-9] : json.loads(open("fastbuild/" + entry, 'r').read())})
+            except (IOError, ValueError):
+                pass
+            legacyFiles.append("fastbuild/" + entry)
+        elif fnmatch.fnmatch(entry, "*.o") or (entry in ["configname.txt", "compiletimes.json"]):
+            legacyFiles.append("fastbuild/" + entry)
+
+    buildState["checksums"].update(readLegacyJson("repository.md5", dict()))
+    buildState["includes"].update(readLegacyJson("includes.cache", dict()))
+
+    stored = readLegacyJson("fingerprints.json", dict())
+    if "files" in stored.keys():
+        buildState["meta"].update({"hash_algorithm" : stored["algorithm"]})
+        buildState["fingerprints"].update(stored["files"])
+
+    metrics = readLegacyJson("metrics.json", dict())
+    for kind in metrics:
+        for name in metrics[kind]:
+            buildState["metrics"].update({kind + "/" + name : metrics[kind][name]})
+
+    compilers = readLegacyJson("compiler.json", None)
+    if compilers != None:
+        buildState["meta"].update({"compilers" : compilers})
+
+    try:
+        buildState["meta"].update({"version" : open("fastbuild/repversion.txt", 'r').read()})
+        legacyFiles.append("fastbuild/repversion.txt")
+    except IOError:
+        pass
+
+    if len(legacyFiles) == 0:
+        return
+
+    writeBuildState()
+    for filename in legacyFiles:
+        os.remove(filename)
+    fastprint("Migrated " + str(len(legacyFiles)) + " files of old fastbuild/ layout to fastbuild/state.db", level=1)
+
+
+def writeBuildState():
+    """Writes rows changed since last load or write to the build state database, 
+    all tables are committed in one transaction.
+    """
+    global stateSnapshot
+
+    if stateDatabase == None:
+        return
+
+    with stateDatabase:
+        for name in stateTables:
+            (keyColumn, valueColumns, jsonValues) = stateTables[name]
+            table = buildState[name]
+            snapshot = stateSnapshot[name]
+
+            deleted = [(key,) for key in snapshot if key not in table]
+            changed = list()
+            for key in table:
+                value = table[key]
+                if (key in snapshot) and (snapshot[key] == value):
+                    continue
+                if len(valueColumns) > 1:
+                    changed.append(tuple([key] + value))
+                elif jsonValues:
+                    changed.append((key, json.dumps(value, separators=(",", ":"))))
+                else:
+                    changed.append((key, value))
+
+            stateDatabase.executemany("DELETE FROM " + name + " WHERE " + keyColumn + " = ?", deleted)
+            stateDatabase.executemany("INSERT OR REPLACE INTO " + name + " VALUES (" 
+                + ", ".join(["?"] * (len(valueColumns) + 1)) + ")", changed)
+
+    stateSnapshot = dict()
+    for name in buildState:
+        stateSnapshot.update({name : dict(buildState[name])})
+
+
+def commitBuildState():
+    """Collects working structures of the build into state tables and commits them"""
+    if stateDatabase == None:
+        return
+    saveFingerprints()
+    saveBuildMetrics()
+    writeBuildState()
+
+
+def statSignature(path):
+    """Returns stat signature of file or directory (size, modification time, inode), 
+    or None if it does not exist
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+
+def manifestKey():
+    """Returns options of the run which the build depends on, besides files"""
+    return [verstring, os.path.realpath(configFileName), os.path.realpath("."), recursionThreshold, 
+        systemEncoding, os.environ.get("PATH", "")]
+
+
+def gitStateFiles():
+    """Returns files describing git HEAD and index of the repository: HEAD, branch 
+    it points to, packed refs and index. They are read without running git.
+    """
+    gitdir = os.path.join(repositoryRoot, ".git")
+    if os.path.isfile(gitdir):
+        #work tree or submodule, .git file points to the git directory
+        f = open(gitdir, "r")
+        line = f.read().strip()
+        f.close()
+        if line.startswith("gitdir:"):
+            gitdir = os.path.join(repositoryRoot, line[7:].strip())
+
+    files = [os.path.join(gitdir, "HEAD"), os.path.join(gitdir, "index"), os.path.join(gitdir, "packed-refs")]
+    try:
+        f = open(os.path.join(gitdir, "HEAD"), "r")
+        head = f.read().strip()
+        f.close()
+    except IOError:
+        return files
+    if head.startswith("ref:"):
+        files.append(os.path.join(gitdir, head[4:].strip()))
+    return files
+
+
+def writeManifest(cfg, finaldependency):
+    """Writes manifest of successful build: stat signatures of everything the build 
+    read or produced (config, fastbuild itself, compiler, sources, dependencies, 
+    directories of patterns, git HEAD and index, outputs). Manifest is not written 
+    if some source or dependency was modified just now, as its next change could 
+    keep the same signature, or if some restored dependency tree was outdated by 
+    changed includes in this build, so the next build checks all trees again.
+    """
+    if outdatedTreesCount > 0:
+        return
+
+    paths = [configFileName, os.path.realpath(__file__)]
+    binary = None
+    if len(cfg["compiler"].split()) > 0:
+        binary = shutil.which(cfg["compiler"].split()[0])
+    if binary != None:
+        paths.append(os.path.realpath(binary))
+
+    paths.extend(finaldependency.sourcePaths())
+    for dep in finaldependency.dependencyPaths():
+        paths.append(pathFromRoot(dep))
+    contents = set(paths)
+    for entry in usedGlobCache.values():
+        for (directory, mtime) in entry["dirs"]:
+            paths.append(directory)
+    paths.extend(gitStateFiles())
+
+    products = buildProducts(cfg)
+    for mt in products:
+        paths.append(products[mt]["output"])
+    if len(products) < len(cfg["macrotargets"]):
+        paths.append(cfg["linker_output_file"])
+
+    files = list()
+    seen = set()
+    recent = time.time_ns() - 2000000000
+    for path in paths:
+        if path in seen:
+            continue
+        seen.add(path)
+        signature = statSignature(path)
+        if (signature != None) and (signature[1] > recent) and (path in contents):
+            return
+        files.append([path, signature])
+
+    tmpname = manifestFileName + "." + str(os.getpid()) + ".tmp"
+    f = open(tmpname, "w")
+    json.dump({"key" : manifestKey(), "files" : files}, f)
+    f.close()
+    os.replace(tmpname, manifestFileName)
+
+
+def nullBuild():
+    """Fast path of build without changes: checks stat signatures of all files in 
+    manifest of the last successful build. Returns True if none of them changed, 
+    no process is started and build state is not opened for that.
+    """
+    try:
+        f = open(manifestFileName, "r")
+        manifest = json.load(f)
+        f.close()
+    except (IOError, ValueError):
+        return False
+
+    if manifest.get("key") != manifestKey():
+        return False
+    for (path, signature) in manifest.get("files", list()):
+        if statSignature(path) != signature:
+            return False
+    return True
+
+
+def importBuildModules():
+    """Imports modules used by the build and creates its locks. They are not needed 
+    by the null build check, which only reads the manifest and stats files, so 
+    fastbuild imports them after it.
+    """
+    global Popen, PIPE, STDOUT, call, hashlib, threading, queue, shutil, shlex, signal
+    global buildMetricsLock, traceLock, scanStatsLock, buildCancelled, runningChildrenLock, printLock
+    global sourcesPending, pipelineStopped, globCacheLock, fingerprintsLock
+    from subprocess import Popen, PIPE, STDOUT
+    from subprocess import call
+    import hashlib
+    import threading
+    import queue
+    import shutil
+    import shlex
+    import signal
+
+    buildMetricsLock = threading.Lock()
+    traceLock = threading.Lock()
+    scanStatsLock = threading.Lock()
+    buildCancelled = threading.Event()
+    runningChildrenLock = threading.Lock()
+    printLock = threading.Lock()
+    sourcesPending = threading.Event()
+    pipelineStopped = threading.Event()
+    globCacheLock = threading.Lock()
+    fingerprintsLock = threading.Lock()
+
+
+def loadGlobCache():
+    """Loads resolved file name patterns of previous run from build state"""
+    global globCache
+    globCache = buildState["globs"]
+
+
+def saveGlobCache():
+    """Saves patterns resolved in this run to build state, unused patterns are dropped"""
+    buildState.update({"globs" : usedGlobCache})
+
+
+def globDirectories(pattern):
+    """Returns directories (with their mtime_ns) whose listing may affect the result 
+    of the pattern: the leading directory without wildcards and its subdirectories 
+    down to the depth of the pattern (all subdirectories for ** patterns). Adding, 
+    removing or renaming a file changes mtime of the directory containing it.
+    """
+    parts = pattern.split("/")
+    base = list()
+    for part in parts[:-1]:
+        if ("*" in part) or ("?" in part) or ("[" in part):
+            break
+        base.append(part)
+
+    rest = parts[len(base):]
+    depth = len(rest) - 1
+    if "**" in rest:
+        depth = None
+
+    basedir = "/".join(base)
+    if basedir == "" and len(base) > 0:
+        basedir = "/"
+    elif basedir == "":
+        basedir = "."
+
+    dirs = list()
+    visited = set()
+    stack = [(basedir, 0)]
+    while len(stack) > 0:
+        (directory, level) = stack.pop()
+        try:
+            st = os.stat(directory)
+        except OSError:
+            dirs.append([directory, None])
+            continue
+        if (st.st_dev, st.st_ino) in visited:
+            continue
+        visited.add((st.st_dev, st.st_ino))
+        dirs.append([directory, st.st_mtime_ns])
+
+        if (depth == None) or (level < depth):
+            try:
+                for entry in os.scandir(directory):
+                    if entry.is_dir():
+                        stack.append((directory + "/" + entry.name, level + 1))
+            except OSError:
+                continue
+
+    return dirs
+
+
+def globCacheValid(entry):
+    """Checks that none of directories of the cached pattern was changed"""
+    for (directory, mtime) in entry["dirs"]:
+        try:
+            current = os.stat(directory).st_mtime_ns
+        except OSError:
+            current = None
+        if current != mtime:
+            return False
+    return True
+
+
+def traceLane():
+    """Returns trace lane (tid) of the current thread, lanes are named after threads"""
+    thread = threading.current_thread()
+    key = (threading.get_ident(), thread.name)
+    if key not in traceLanes:
+        lane = len(traceLanes)
+        traceLanes.update({key : lane})
+        traceEvents.append({"name" : "thread_name", "ph" : "M", "pid" : 1, "tid" : lane, "args" : {"name" : thread.name}})
+    return traceLanes[key]
+
+
+def traceComplete(name, category, start, duration, args=None):
+    """Records span of the build timeline (--trace) started at start (time.time()) 
+    and lasted duration seconds
+    """
+    if traceFileName == None:
+        return
+    event = {"name" : name, "cat" : category, "ph" : "X", "pid" : 1, 
+        "ts" : int((start - traceOrigin) * 1000000), "dur" : int(duration * 1000000)}
+    if args != None:
+        event.update({"args" : args})
+    with traceLock:
+        event.update({"tid" : traceLane()})
+        traceEvents.append(event)
+
+
+def traceCounter(name, values):
+    """Records values of counter to the build timeline (--trace)"""
+    if traceFileName == None:
+        return
+    with traceLock:
+        traceEvents.append({"name" : name, "ph" : "C", "pid" : 1, "tid" : 0, 
+            "ts" : int((time.time() - traceOrigin) * 1000000), "args" : values})
+
+
+def traceStep(name):
+    """Ends span of the current step of main() and starts span of the next one (if name is given)"""
+    global traceCurrentStep
+    if traceCurrentStep != None:
+        traceComplete(traceCurrentStep[0], "step", traceCurrentStep[1], time.time() - traceCurrentStep[1])
+    traceCurrentStep = None
+    if name != None:
+        traceCurrentStep = (name, time.time())
+
+
+def writeTrace():
+    """Writes recorded timeline in Chrome trace event format (chrome://tracing, Perfetto)"""
+    if traceFileName == None:
+        return
+    traceStep(None)
+    f = open(traceFileName, "w")
+    json.dump({"traceEvents" : traceEvents, "displayTimeUnit" : "ms"}, f)
+    f.close()
+    fastprint("Trace written to " + traceFileName + " (" + str(len(traceEvents)) + " events)", level=1)
+
+
+class traceSpan:
+    """Context manager recording span of the build timeline (--trace)"""
+    def __init__(self, name, category, args=None):
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        traceComplete(self.name, self.category, self.start, time.time() - self.start, self.args)
+        return False
+
+
 def resolveFilesRegexp(macrotargetRegexp):
     """Resolve regular expressions in file names. For example,
     it will convert somedir/*.cpp to somedir/foo.cpp and somedir/bar.cpp 
-    (if those file both are on disk in somedir)
-    calls to dir utillity
+    (if those file both are on disk in somedir), ** matches any number of directories.
+    Results are cached and reused while mtimes of the directories they were
+    listed from are not changed.
     """
-    child = Popen("dir -x1 " + macrotargetRegexp, shell=True, stdin=PIPE, stdout=PIPE) 
-    files = list(child.stdout.read().split(b"\n"))
+    import glob
+
+    global globCacheHits
+    global globCacheMisses
 
-    if child.wait() != 0:
-        sys.exit("\n\n" + macrotargetRegexp + " has incorrect, inaccessible or unreadable files. (status=" + str(child.wait())
-            + ") \"dir -x1 " + macrotargetRegexp + "\" shell command failed. Please check config and access rights.")
+    with globCacheLock:
+        entry = globCache.get(macrotargetRegexp)
+
+    if (entry != None) and globCacheValid(entry):
+        with globCacheLock:
+            globCacheHits = globCacheHits + 1
+            usedGlobCache.update({macrotargetRegexp : entry})
+        return entry["files"]
+
+    dirs = globDirectories(macrotargetRegexp)
+    files = list()
+    for item in sorted(glob.glob(macrotargetRegexp, recursive=True)):
+        if not os.path.isdir(item):
+            files.append(item)
+
+    entry = dict({"dirs" : dirs, "files" : files})
+    with globCacheLock:
+        globCacheMisses = globCacheMisses + 1
+        #directory modified just now can be modified again within the same mtime tick
+        if all((mtime == None) or (time.time() - mtime / 1e9 > 2) for (directory, mtime) in dirs):
+            usedGlobCache.update({macrotargetRegexp : entry})
 
     return files
 
 
-def resolveRelativePath(path):
-    """Converts relative paths to absolute paths using the realpath utility
-    This function is called for each dependency file in C/C++ code, so 
-    all filenames are comparable to each other.
+def resolveMacrotargetFiles(patterns):
+    """Resolves all file name patterns of macrotarget. Patterns starting with "!" 
+    exclude matching files. Returns list of files (without duplicates) and list of 
+    patterns which matched no files.
     """
-    child = Popen("realpath --relative-to=\""+repositoryRoot+"\" " + path, shell=True, stdin=PIPE, stdout=PIPE) 
-    files = list(child.stdout.read().split(b"\n"))
+    files = list()
+    excluded = set()
+    emptyPatterns = list()
+
+    for pattern in patterns:
+        if pattern.startswith("!"):
+            with traceSpan("glob " + pattern, "glob"):
+                excluded.update(resolveFilesRegexp(pattern[1:]))
+            continue
+        with traceSpan("glob " + pattern, "glob"):
+            matched = resolveFilesRegexp(pattern)
+        if len(matched) == 0:
+            emptyPatterns.append(pattern)
+        files.extend(matched)
 
-    if child.wait() != 0:
-        sys.exit("\n\n" + path + " has incorrect, inaccessible or unreadable files. (status=" + str(child.wait())
-            + ") \"realpath --relative-to=. " + path + "\" shell command failed. Please check config and access rights.")
+    src = list()
+    seen = set()
+    for item in files:
+        if (item not in excluded) and (item not in seen):
+            seen.add(item)
+            src.append(item)
 
-    return str(files[0].decode(systemEncoding))
+    return src, emptyPatterns
 
 
+def macrotargetPatterns(entry):
+    """Returns file name patterns of macrotarget: the entry itself, or its "sources" 
+    when macrotarget is described by object (build product).
+    """
+    if isinstance(entry, dict):
+        return entry.get("sources", list())
+    return entry
 
-def findDependeciesInFile(filename, deep, maxhops, deplist):
-    """The function recursively searches for directives for inclusions in C++ code files, 
-    specifies the maximum depth of recursion. Files are included in the returned list 
-    of dependencies without duplicates.
+
+def pathFromRoot(path):
+    """Converts path relative to repository root to path relative to working directory"""
+    if (len(relativeToRoot) > 0):
+        return relativeToRoot + "/" + path
+    return path
+
+
+def pathToRoot(path):
+    """Converts path relative to working directory to path relative to repository 
+    root. Paths made by pathFromRoot are converted by their prefix, other ones 
+    (sources of macrotargets) are resolved once and memoized.
     """
-    if deep >= maxhops:
-        return deplist
+    if (len(relativeToRoot) > 0) and path.startswith(relativeToRoot + "/"):
+        return path[len(relativeToRoot) + 1:]
+    rootPath = rootPathsCache.get(path)
+    if rootPath == None:
+        rootPath = os.path.relpath(os.path.realpath(path), os.path.realpath(repositoryRoot))
+        rootPathsCache.update({path : rootPath})
+    return rootPath
+
+
+def resolveRelativePath(path, directory=""):
+    """Converts relative paths to paths relative to the repository root, the same 
+    way as "realpath --relative-to" does (symlinks are resolved), but without spawning 
+    a process. This function is called for each dependency file in C/C++ code, so 
+    all filenames are comparable to each other. Results are memoized per run by 
+    (including directory, include spelling).
+    """
+    global resolveCacheHits
+    global resolveLookups
+
+    key = (directory, path)
+    if key in resolvedPathsCache:
+        with scanStatsLock:
+            resolveCacheHits = resolveCacheHits + 1
+        return resolvedPathsCache[key]
+
+    with scanStatsLock:
+        resolveLookups = resolveLookups + 1
+    fullpath = path
+    if directory != "":
+        fullpath = directory + "/" + path
+
+    realpath = os.path.realpath(fullpath)
+    if not os.path.isdir(os.path.dirname(realpath)):
+        sys.exit("\n\n" + fullpath + " has incorrect, inaccessible or unreadable files. "
+            + "Path resolution failed. Please check config and access rights.")
+
+    resolved = os.path.relpath(realpath, os.path.realpath(repositoryRoot))
+    resolvedPathsCache.update({key : resolved})
+    return resolved
+
+
+def hashFileContent(filebytes):
+    """Returns checksum of file content by hash algorithm selected in config
+    ("hash_algorithm": "git" (default, git blob id), "md5", "sha1", "blake2b" or "xxhash")
+    """
+    if hashAlgorithm == "git":
+        return hashlib.sha1(b"blob " + str(len(filebytes)).encode('ascii') + b"\0" + filebytes).hexdigest()
+    if hashAlgorithm == "md5":
+        return hashlib.md5(filebytes).hexdigest()
+    if hashAlgorithm == "sha1":
+        return hashlib.sha1(filebytes).hexdigest()
+    if hashAlgorithm == "blake2b":
+        return hashlib.blake2b(filebytes, digest_size=16).hexdigest()
+    if hashAlgorithm == "xxhash":
+        try:
+            import xxhash
+        except ImportError:
+            sys.exit("hash_algorithm \"xxhash\" requires python xxhash module (pip3 install xxhash)")
+        return xxhash.xxh3_128(filebytes).hexdigest()
+    sys.exit("Unknown hash_algorithm \"" + hashAlgorithm + "\" in config! (vars: git, md5, sha1, blake2b, xxhash)")
+
+
+def loadFingerprints():
+    """Loads fingerprint table (path -> size, mtime_ns, inode, checksum) from build 
+    state. Table is dropped when hash algorithm in config is changed.
+    """
+    global fingerprints
+    fingerprints = buildState["fingerprints"]
+    if buildState["meta"].get("hash_algorithm", hashAlgorithm) != hashAlgorithm:
+        fingerprints.clear()
+
+
+def saveFingerprints():
+    """Saves fingerprint table to build state, so unchanged files are not read on next run"""
+    buildState["meta"].update({"hash_algorithm" : hashAlgorithm})
+    buildState.update({"fingerprints" : fingerprints})
+
+
+def findRepositoryRoot():
+    """Returns root of git repository containing current directory: the nearest 
+    directory having .git in it, or the one reported by git if there is none.
+    """
+    directory = os.path.realpath(".")
+    while True:
+        if os.path.exists(os.path.join(directory, ".git")):
+            return directory
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            break
+        directory = parent
+
+    with traceSpan("git rev-parse", "git"):
+        child = Popen("git rev-parse --show-toplevel", shell=True, stdin=PIPE, stdout=PIPE) 
+        return str(list(child.stdout.read().split(b"\n"))[0].decode(systemEncoding))
+
+
+def runGit(arguments):
+    """Runs git with arguments in repository root, returns its output or None if it failed"""
+    with traceSpan("git " + arguments[0], "git"):
+        child = Popen(["git", "-C", repositoryRoot] + arguments, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+        output = child.communicate()[0]
+    if child.returncode != 0:
+        return None
+    return output
+
+
+def parseGitStatus(output):
+    """Parses output of "git status --porcelain=v2 -z --branch". Returns HEAD commit 
+    (None if there is no commits yet) and list of entries: index status, work tree 
+    status, path, blob id in index and original path of renamed files.
+    """
+    head = None
+    entries = list()
+    records = output.split(b"\0")
+    i = 0
+    while i < len(records):
+        record = records[i].decode(systemEncoding, errors="replace")
+        i = i + 1
+        if record.startswith("# branch.oid "):
+            if record[13:] != "(initial)":
+                head = record[13:]
+        elif record.startswith("1 "):
+            fields = record.split(" ", 8)
+            entries.append((fields[1][0], fields[1][1], fields[8], fields[7], None))
+        elif record.startswith("2 "):
+            fields = record.split(" ", 9)
+            entries.append((fields[1][0], fields[1][1], fields[9], fields[7], records[i].decode(systemEncoding, errors="replace")))
+            i = i + 1
+        elif record.startswith("u "):
+            fields = record.split(" ", 10)
+            entries.append(("U", "U", fields[10], None, None))
+        elif record.startswith("? "):
+            entries.append(("?", "?", record[2:], None, None))
+    return head, entries
+
+
+def readTreeBlobs(head):
+    """Reads blob ids of all files of the commit tree with "git ls-tree" """
+    blobs = dict()
+    output = runGit(["ls-tree", "-r", "-z", "--full-tree", head])
+    if output == None:
+        return blobs
+    for record in output.split(b"\0"):
+        if len(record) == 0:
+            continue
+        (info, path) = record.decode(systemEncoding, errors="replace").split("\t", 1)
+        fields = info.split(" ")
+        if fields[1] == "blob":
+            blobs.update({path : fields[2]})
+    return blobs
+
+
+def updateTreeBlobs(blobs, recorded, head):
+    """Updates blob ids of the recorded commit tree to the new one by "git diff --raw".
+    Returns False if the diff is not available.
+    """
+    output = runGit(["diff", "--raw", "-z", "--no-abbrev", "--no-renames", recorded, head])
+    if output == None:
+        return False
+    records = output.split(b"\0")
+    for i in range(0, len(records) - 1, 2):
+        fields = records[i].decode(systemEncoding, errors="replace").lstrip(":").split(" ")
+        path = records[i + 1].decode(systemEncoding, errors="replace")
+        if (fields[4] == "D") or (fields[1] == "160000"):
+            if path in blobs:
+                del blobs[path]
+        else:
+            blobs.update({path : fields[3]})
+    return True
 
-    try:
-        f = open(filename, 'r')
-        filetxt = f.read()
-        f.close()       
-    except IOError:
-        sys.exit(filename + " file read error! Critical!")
 
+def loadGitState():
+    """Runs git once per build: reads status of the work tree, and blob ids of tracked 
+    files, which are used as their checksums (with "hash_algorithm": "git"). Blob ids 
+    of HEAD tree are kept in build state, when HEAD moves (commit, branch switch) 
+    they are updated by diff against the recorded tree.
+    """
+    global gitStatusEntries
+    gitIndexBlobs.clear()
+    gitDirtyPaths.clear()
+
+    output = runGit(["status", "--porcelain=v2", "-z", "--branch"])
+    if output == None:
+        gitStatusEntries = list()
+        return
+    (head, gitStatusEntries) = parseGitStatus(output)
+
+    if hashAlgorithm != "git":
+        return
+
+    blobs = buildState["blobs"]
+    recorded = buildState["meta"].get("git_head")
+    if head == None:
+        blobs.clear()
+    elif recorded != head:
+        if (recorded == None) or (not updateTreeBlobs(blobs, recorded, head)):
+            blobs.clear()
+            blobs.update(readTreeBlobs(head))
+    buildState["meta"].update({"git_head" : head})
+
+    #blob in index is content of work tree file only if work tree status is clean
+    for (indexStatus, worktreeStatus, path, blob, origPath) in gitStatusEntries:
+        if (worktreeStatus == ".") and (indexStatus != "D") and (blob != None):
+            gitIndexBlobs.update({path : blob})
+        else:
+            gitDirtyPaths.add(path)
+        if origPath != None:
+            gitDirtyPaths.add(origPath)
+
+
+def gitBlobId(path):
+    """Returns git blob id of the file if its content in work tree is known to git, or None"""
+    if hashAlgorithm != "git":
+        return None
+    rootPath = pathToRoot(path)
+    if rootPath in gitDirtyPaths:
+        return None
+    if rootPath in gitIndexBlobs:
+        return gitIndexBlobs[rootPath]
+    return buildState["blobs"].get(rootPath)
+
+
+def fileChecksum(path):
+    """Returns checksum of file content. Checksum of tracked file clean in git work tree 
+    is its blob id. Other files are read and hashed only when their stat signature 
+    (size, mtime_ns, inode) differs from the fingerprint table, and at most once per run. 
+    Raises IOError when file can not be read.
+    """
+    global fingerprintHits
+    global fingerprintReads
+    global gitBlobHits
+
+    path = os.path.normpath(path)
+    if path in runChecksums:
+        return runChecksums[path]
+
+    blob = gitBlobId(path)
+    if blob != None:
+        with scanStatsLock:
+            gitBlobHits = gitBlobHits + 1
+        runChecksums.update({path : blob})
+        return blob
+
+    st = os.stat(path)
+    signature = [st.st_size, st.st_mtime_ns, st.st_ino]
+
+    with fingerprintsLock:
+        entry = fingerprints.get(path)
+
+    if (entry != None) and (entry[0:3] == signature):
+        with scanStatsLock:
+            fingerprintHits = fingerprintHits + 1
+        checksum = entry[3]
+    else:
+        with scanStatsLock:
+            fingerprintReads = fingerprintReads + 1
+        with traceSpan("hash " + path, "hash"):
+            f = open(path, 'rb')
+            checksum = hashFileContent(f.read())
+            f.close()
+        #file modified just now can be modified again within the same mtime tick
+        with fingerprintsLock:
+            if time.time() - st.st_mtime > 2:
+                fingerprints.update({path : signature + [checksum]})
+            elif path in fingerprints:
+                del fingerprints[path]
+
+    runChecksums.update({path : checksum})
+    return checksum
+
+
+def parseIncludeDirectives(filetxt):
+    """Extracts file names from #include "..." directives of C/C++ code text 
+    in order of their appearance. Directives commented out by // are skipped.
+    """
+    includes = list()
     offset = 0
 
     while (1):
@@ -152,509 +1101,3028 @@ def findDependeciesInFile(filename, deep, maxhops, deplist):
             continue
 
         includeEnd = filetxt.find("\"", includeStart + 11, includeStart + 128)
-        dependency = filetxt[includeStart+10 : includeEnd]
+        includes.append(filetxt[includeStart+10 : includeEnd])
         
         offset = includeStart + 15
 
-        slash = filename.rfind("/")
-        path = ""
+    return includes
+
+
+def loadIncludesCache():
+    """Loads cache of direct inclusions of files (keyed by checksum of file content)
+    from build state.
+    """
+    global includesCache
+    includesCache = buildState["includes"]
+
+
+def saveIncludesCache(deps):
+    """Saves direct inclusions of files to build state: entries used in this run are 
+    added to the cache, other entries are kept while a source or dependency of the 
+    graph has this content (files of restored trees are not parsed in every run). 
+    Entries of old contents of files are dropped.
+    """
+    reachable = set()
+    for path in deps.sourcePaths() + [pathFromRoot(dep) for dep in deps.dependencyPaths()]:
+        try:
+            reachable.add(fileChecksum(path))
+        except IOError:
+            continue
+    cache = dict((checksum, includesCache[checksum]) for checksum in includesCache if checksum in reachable)
+    cache.update(usedIncludesCache)
+    buildState.update({"includes" : cache})
+
+
+def getDirectIncludes(filename):
+    """Returns direct inclusions of the file. Inclusion lists are cached by checksum 
+    of file content, so every unique header is parsed once, not once per source.
+    """
+    global includesParsedCount
+    global includesRestoredCount
+
+    if filename in directIncludes:
+        return directIncludes[filename]
+
+    try:
+        checksum = fileChecksum(filename)
+
+        if checksum in includesCache:
+            with scanStatsLock:
+                includesRestoredCount = includesRestoredCount + 1
+            includes = includesCache[checksum]
+        else:
+            with scanStatsLock:
+                includesParsedCount = includesParsedCount + 1
+            f = open(filename, 'rb')
+            filebytes = f.read()
+            f.close()       
+            includes = parseIncludeDirectives(filebytes.decode(systemEncoding, errors="replace"))
+    except IOError:
+        sys.exit(filename + " file read error! Critical!")
+
+    usedIncludesCache.update({checksum : includes})
+    directIncludes.update({filename : includes})
+    return includes
+
+
+def collectDependencies(filename, resolved, deep, maxhops, stack):
+    """Recursively collects all dependencies of the file (without duplicates, in order
+    of inclusion). Transitive dependencies of every header are computed once and reused
+    for each file including it. Returns the list and the lowest depth of a file 
+    in the current inclusion chain reached by a cyclic inclusion; list is memoized 
+    only when it is not truncated by such a cycle or by the recursion threshold.
+    """
+    global closuresReusedCount
+
+    if resolved in dependencyClosures:
+        with scanStatsLock:
+            closuresReusedCount = closuresReusedCount + 1
+        return dependencyClosures[resolved], sys.maxsize
+
+    if deep >= maxhops:
+        return list(), -1
+
+    stack.update({resolved : deep})
+    deplist = list()
+    seen = set()
+    lowest = sys.maxsize
 
-        if slash != -1:
-            path = filename[0 : slash]
+    slash = filename.rfind("/")
+    path = ""
+
+    if slash != -1:
+        path = filename[0 : slash]
+
+    for dependency in getDirectIncludes(filename):
+        resolvedDependency = resolveRelativePath(dependency, path)
+
+        if path != "":
+            dependency = path + "/" + dependency 
+
+        if resolvedDependency not in seen:
+            seen.add(resolvedDependency)
+            deplist.append(resolvedDependency)
+
+        if resolvedDependency in stack:
+            lowest = min(lowest, stack[resolvedDependency])
+            continue
+
+        (subdeps, sublowest) = collectDependencies(dependency, resolvedDependency, deep + 1, maxhops, stack)
+        lowest = min(lowest, sublowest)
+
+        for subdep in subdeps:
+            if subdep not in seen:
+                seen.add(subdep)
+                deplist.append(subdep)
+
+    del stack[resolved]
+
+    if lowest >= deep:
+        dependencyClosures.update({resolved : deplist})
+
+    return deplist, lowest
+
+
+def printDependencyTree(filename, deep, maxhops, deplist):
+    """Prints dependency tree of the file in order of inclusion, 
+    every dependency is printed once (used by -t option).
+    """
+    if deep >= maxhops:
+        return
+
+    slash = filename.rfind("/")
+    path = ""
+
+    if slash != -1:
+        path = filename[0 : slash]
+
+    for dependency in getDirectIncludes(filename):
+        resolvedDependency = resolveRelativePath(dependency, path)
 
         if path != "":
             dependency = path + "/" + dependency 
 
-        resolvedDependency = resolveRelativePath(dependency)
+        if not (resolvedDependency in deplist):
+            i = 0
+            fastprint(" ", fastend="")
+            while i < deep:
+                fastprint("--", fastend="") 
+                i = i + 1   
+            fastprint(">  " + resolvedDependency) #!
+
+            deplist.append(resolvedDependency)
+            printDependencyTree(dependency, deep + 1, maxhops, deplist)
+
+
+def findDependeciesInFile(filename, deep, maxhops, deplist):
+    """The function recursively searches for directives for inclusions in C++ code files, 
+    specifies the maximum depth of recursion. Files are included in the returned list 
+    of dependencies without duplicates.
+    """
+    if treeOut:
+        printDependencyTree(filename, deep, maxhops, list())
+
+    with traceSpan("scan " + filename, "deps"):
+        (deps, lowest) = collectDependencies(filename, resolveRelativePath(filename), deep, maxhops, dict())
+
+    for dep in deps:
+        if not (dep in deplist):
+            deplist.append(dep)
+    
+    #dump tree only for 1-st range files
+    if deep == 1:
+        checksum = fileChecksum(filename)
+        usedDependencyTrees.add(checksum)
+        dependencyTrees.update({checksum : list(deplist)})
+
+    return deplist  
+
+
+def getConfig():
+    """Reads the configuration file and converts it from the json format to a 
+    dictionary that stores the build parameters of the current project. Recommendations for 
+    filling the configuration file can be found in the Readme or you can study the sample file
+    """
+    try:
+        f = open(configFileName, 'r')
+        conftxt = f.read()
+        f.close()       
+    except IOError:
+        sys.exit("Error while open file " + configFileName + "!")
+
+    #print(conftxt)
+
+    try:
+        configObject = json.loads(conftxt)
+    except json.decoder.JSONDecodeError:
+        sys.exit("config file is incorrect!")
+
+    return configObject
+
+
+def checksumModificatedSinceLastFastbuild(fname, oldchk):
+    """Determines whether the checksum of the file has changed since the 
+    last time the hash table was saved to the disk.
+    """
+    #pprint.pprint(oldchk)
+    if(fname not in oldchk.keys()):
+        return True
+
+    if rebuildall:
+        return True
+
+    checksumNew = fileChecksum(fname)
+    checksumOld = oldchk[fname]
+    if checksumNew == checksumOld:
+        return False
+    else:
+        return True
+
+
+def getModificatedByGit(correctEndings, untrackedAction, filestree, pollHeaders):
+    """With the repository data, git determines the modification of 
+    files in the file tree with the specified extensions (status is read once per build 
+    by loadGitState()). For files that are not specified in git, the modified function 
+    attempts to determine the fact of the change using a hash table.
+    """
+    oldchecksums = buildState["checksums"]
+
+    toprocessing = list()
+
+    #git paths are relative to repository root, sources are named as in file lists of macrotargets
+    spellings = dict()
+    if not pollHeaders:
+        for source in filestree.sourcePaths():
+            spellings.update({pathToRoot(source) : source})
+
+    #index and work tree status (XY) of entries of "git status --porcelain=v2":
+    #M -> modifing -> rebuild
+    #A -> new file -> rebuild
+    #D -> deleted -> ignore
+    #R -> renamed -> rebuild
+    #C -> copied -> rebuild
+    #? -> untracked -> accept or ignore by untracked_action
+
+    for (indexStatus, worktreeStatus, path, blob, origPath) in gitStatusEntries:
+        if (indexStatus == "D") or (worktreeStatus == "D"):
+            continue
+
+        if (indexStatus == "?") and (untrackedAction == "ignore"):
+            continue
+
+        end = None
+        for currentEnding in correctEndings:
+            if path.endswith(currentEnding):
+                end = currentEnding
+                break
+        if end == None:
+            continue
+
+        candidateName = spellings.get(path, pathFromRoot(path))
+
+        if(not checksumModificatedSinceLastFastbuild(candidateName, oldchecksums)):
+            continue
+
+        fastprint("Adding file: " + candidateName + " [" + end + "/" + worktreeStatus + "/git]")
+        toprocessing.append(candidateName)
+
+    # Search in hashes
+
+    if pollHeaders:
+        candidates = [pathFromRoot(dep) for dep in filestree.dependencyPaths()]
+    else:
+        candidates = filestree.sourcePaths()
+
+    queued = set(toprocessing)
+
+    for candidate in candidates:
+        if candidate in queued:
+            continue
+        if checksumModificatedSinceLastFastbuild(candidate, oldchecksums):
+            for currentEnding in correctEndings:
+                cnt = len(currentEnding)
+                end = candidate[-1*cnt:]
+                if end == currentEnding:
+                    toprocessing.append(candidate)
+                    queued.add(candidate)
+                    if not rebuildall:
+                        fastprint("Adding file: " + candidate + " [" + end + "/" + hashAlgorithm + "]")
+                    else:
+                        fastprint("Adding file: " + candidate + " [" + end + "/rebuildall]")
+                    break
+
+    return toprocessing
+
+
+
+def selectDependecies(deps, headers):
+    """Finds which source files depend on the changed header files. 
+    Forms and returns a list of these dependencies.
+    """
+    sourcesDependence = list()
+    seen = set()
+
+    for header in headers:
+        for source in deps.dependentsOf(pathToRoot(header)):
+            if source not in seen:
+                seen.add(source)
+                sourcesDependence.append(source)
+                #fastprint("--> Adding file: " + source + " [dependency of \""+header+"\"]")
+
+    return sourcesDependence
+
+
+def getCompilerIdentity(compiler):
+    """Returns string identifying the compiler binary and its version. Output of 
+    "compiler --version" is cached in build state and is requested again
+    only when path, size or modification time of the compiler binary is changed.
+    """
+    binary = None
+    if len(compiler.split()) > 0:
+        binary = shutil.which(compiler.split()[0])
+    if binary == None:
+        return compiler
+
+    binary = os.path.realpath(binary)
+    st = os.stat(binary)
+    signature = [binary, st.st_size, st.st_mtime_ns]
+
+    identities = dict(buildState["meta"].get("compilers", dict()))
+
+    if (compiler in identities) and (identities[compiler]["binary"] == signature):
+        return identities[compiler]["identity"]
+
+    child = Popen(compiler + " --version", shell=True, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+    version = child.stdout.read()
+    child.wait()
+    identity = binary + " " + hashlib.md5(version).hexdigest()
+
+    identities.update({compiler : {"binary" : signature, "identity" : identity}})
+    buildState["meta"].update({"compilers" : identities})
+
+    return identity
+
+
+def calculateObjectKey(source, deps):
+    """Calculates content key of object file of the source. The key is checksum of 
+    compiler identity, flags, source path and content, and paths and contents of all 
+    its dependencies, so an object built once is reused when all of those are the 
+    same again (other config, reverted branch, etc).
+    """
+    def contentChecksum(path):
+        try:
+            return fileChecksum(path)
+        except IOError:
+            return "missing"
+
+    key = hashlib.md5()
+    key.update(objectKeyPrefix.encode('utf-8'))
+    if source in precompiledHeaders:
+        key.update(("pch:" + precompiledHeaders[source] + ":" + precompiledKeys[source] + "\n").encode('utf-8'))
+    key.update((source + ":" + contentChecksum(source) + "\n").encode('utf-8'))
+    for dep in sorted(deps):
+        key.update((dep + ":" + contentChecksum(pathFromRoot(dep)) + "\n").encode('utf-8'))
+    return key.hexdigest()
+
+
+def setObjectKeyPrefix(compilerIdentity, cparams, lparams):
+    """Sets part of object keys common for all sources: compiler identity and flags"""
+    global objectKeyPrefix
+    objectKeyPrefix = compilerIdentity + "\n" + cparams + "\n" + lparams + "\n"
+
+
+def calculateObjectKeys(filetree, deps):
+    """Calculates content keys of object files for all sources of the file tree"""
+    objectKeys.clear()
+
+    for mt in filetree:
+        for fn in filetree[mt]:
+            objectKeys.update({fn : calculateObjectKey(fn, deps.dependenciesOf(fn))})
+
+
+def linkedObjectPath(source):
+    """Returns path of the object file containing the source: object of its unity 
+    batch, if the source is compiled in one, or its own object.
+    """
+    if source in unityObjects:
+        return objectPath(unityObjects[source])
+    return objectPath(source)
+
+
+def orderBySharedHeaders(sources, deps):
+    """Orders sources so that files including the same headers are next to each other: 
+    sources are sorted by their dependencies, most widely included ones first.
+    """
+    frequency = dict()
+    for source in sources:
+        for dep in deps.dependenciesOf(source):
+            frequency.update({dep : frequency.get(dep, 0) + 1})
+
+    def signature(source):
+        return sorted(deps.dependenciesOf(source), key=lambda dep: (-frequency[dep], dep))
+
+    return sorted(sources, key=lambda source: (signature(source), source))
+
+
+def planUnityBatches(cfg, finalfiles, deps):
+    """Splits sources of every macrotarget into unity batches and generates batch files 
+    in fastbuild/unity. Sources edited since the last build form the working set, 
+    they are compiled separately until the next full rebuild (-a), so editing them 
+    does not recompile whole batches. Changes of headers do not move sources out of 
+    their batches. Batches are kept in build state till the next 
+    full rebuild, so a source leaving its batch changes only this batch. Batch object 
+    is named by keys of its members.
+    """
+    unityBatches.clear()
+    unityObjects.clear()
+
+    if (not "unity_build" in cfg.keys()) or (not cfg["unity_build"]):
+        return
+
+    compiler = cfg["compiler"]
+    batchSize = 8
+    if "unity_batch_size" in cfg.keys():
+        batchSize = cfg["unity_batch_size"]
+
+    state = dict(buildState["meta"].get("unity", dict()))
+    workingSet = set(state.get("working_set", list()))
+    plans = dict(state.get("batches", dict()))
+    previousChecksums = state.get("checksums", dict())
+    replan = rebuildall or (len(previousChecksums) == 0) or (state.get("batch_size") != batchSize)
+    if replan:
+        workingSet = set()
+        plans = dict()
+
+    #only edits of the source itself move it to the working set, changed headers recompile its batch
+    checksums = dict()
+    for mt in finalfiles:
+        for fn in finalfiles[mt]:
+            try:
+                checksums.update({fn : fileChecksum(fn)})
+            except IOError:
+                continue
+            if (not replan) and (previousChecksums.get(fn) != checksums[fn]):
+                workingSet.add(fn)
+
+    if not os.path.isdir("fastbuild/unity"):
+        os.makedirs("fastbuild/unity")
+
+    generated = set()
+    for mt in finalfiles:
+        groups = dict()
+        for fn in finalfiles[mt]:
+            if fn in workingSet:
+                continue
+            language = headerLanguage(compiler, fn)
+            groups.update({language : groups.get(language, list()) + [fn]})
+
+        name = "".join(c if (c.isalnum() or c in "-_") else "_" for c in mt)
+        for language in sorted(groups):
+            group = mt + "\n" + language
+            members = set(groups[language])
+            planned = set()
+            for batch in plans.get(group, list()):
+                planned.update(batch)
+
+            #new sources are in working set, so batches are planned again only when sources are missing in them
+            if not members.issubset(planned):
+                ordered = orderBySharedHeaders(groups[language], deps)
+                #batches are made smaller when there are too few of them to load all threads
+                size = max(2, min(batchSize, -(-len(ordered) // threadLimit)))
+                plans.update({group : [ordered[start : start + size] for start in range(0, len(ordered), size)]})
+
+            for planBatch in plans[group]:
+                batch = [fn for fn in planBatch if fn in members]
+                if len(batch) < 2:
+                    continue
+
+                ending = ".cpp"
+                if language == "c-header":
+                    ending = ".c"
+                unityfile = "fastbuild/unity/" + name + "-" + str(len(generated)) + ending
+                generated.add(unityfile)
+
+                content = ""
+                for fn in batch:
+                    content = content + "#include \"" + os.path.realpath(fn) + "\"\n"
+                try:
+                    current = open(unityfile, "r").read()
+                except IOError:
+                    current = None
+                if current != content:
+                    f = open(unityfile, "w")
+                    f.write(content)
+                    f.close()
+
+                key = hashlib.md5(("unity\n" + "\n".join(objectKeys[fn] for fn in batch)).encode('utf-8')).hexdigest()
+                objectKeys.update({unityfile : key})
+                unityBatches.update({unityfile : batch})
+                for fn in batch:
+                    unityObjects.update({fn : unityfile})
+
+    for leftover in os.listdir("fastbuild/unity"):
+        if ("fastbuild/unity/" + leftover) not in generated:
+            os.remove("fastbuild/unity/" + leftover)
+
+    for group in list(plans.keys()):
+        (mt, language) = group.split("\n", 1)
+        if (mt not in finalfiles) or (language not in [headerLanguage(compiler, fn) for fn in finalfiles[mt]]):
+            del plans[group]
+
+    state.update({"working_set" : sorted(workingSet), "batches" : plans, "batch_size" : batchSize, "checksums" : checksums})
+    buildState["meta"].update({"unity" : state})
+    fastprint("Unity build: " + str(len(unityObjects)) + " sources in " + str(len(unityBatches)) + " batches, " 
+        + str(len(workingSet)) + " sources compiled separately.")
+
+
+def unityBuildList(buildlist):
+    """Replaces sources compiled in unity batches by their batch files"""
+    result = list()
+    for target in buildlist:
+        if target in unityObjects:
+            target = unityObjects[target]
+        if target not in result:
+            result.append(target)
+    return result
+
+
+def objectPath(target):
+    """Returns path of the object file of microtarget in the object cache"""
+    return "fastbuild/objects/" + objectKeys[target] + ".o"
+
+
+def detectMissingObjFiles(filetree):
+    """Finds which object files are not in the cache to 
+    add them to the list for recompilation.
+    """
+    
+    if(not os.path.isdir("fastbuild")):
+        fastprint("fastbuild work directory not found -> rebuild all targets", level=1)
+        os.makedirs("fastbuild")
+
+    if(not os.path.isdir("fastbuild/objects")):
+        os.makedirs("fastbuild/objects")
+
+    newObjFiles = list()
+
+    for mt in filetree:
+        for fn in filetree[mt]:
+            if(not objectAvailable(linkedObjectPath(fn))):
+                #fastprint("---> Adding file: " + fn + " [new object]")
+                newObjFiles.append(fn)
+            #print(mt + " -> " + fn + " -> " + )
+    return newObjFiles
+
+
+def cleanObjectStore(cfg):
+    """Removes files of the local store (objects, pre-linked files and precompiled 
+    headers in fastbuild/objects/ and fastbuild/pch/) which are not used by this build, 
+    except the "object_retention" most recently used ones, and temporary files left 
+    by interrupted builds. Files used by the build are touched, so modification time 
+    is time of their last use.
+    """
+    retention = 256
+    if "object_retention" in cfg.keys():
+        retention = cfg["object_retention"]
+    if retention < 0:
+        return
+
+    used = set(objectKeys.values())
+    used.update(buildState.get("objects", dict()).values())
+    used.update(storeKeysInUse)
+
+    entries = dict()
+    for directory in ["fastbuild/objects", "fastbuild/pch"]:
+        try:
+            filenames = os.listdir(directory)
+        except OSError:
+            continue
+        for filename in filenames:
+            path = os.path.join(directory, filename)
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                continue
+            if filename.endswith(".tmp"):
+                if time.time() - mtime > 3600:
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                continue
+            #files of precompiled header (prefix and binary) are one entry named by its key
+            key = filename.split(".")[0]
+            if key in used:
+                os.utime(path)
+                continue
+            (lastUse, paths) = entries.get(key, (0, list()))
+            paths.append(path)
+            entries.update({key : (max(lastUse, mtime), paths)})
+
+    removed = 0
+    for (lastUse, paths) in sorted(entries.values(), key=lambda entry: entry[0], reverse=True)[retention:]:
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        removed = removed + 1
+    storeKeysInUse.clear()
+    if removed > 0:
+        fastprint("Object store: " + str(removed) + " unused entries removed, " + str(min(len(entries), retention)) + " kept.")
+
+
+class sharedObjectCache:
+    """Object cache shared by several checkouts and concurrent builds ("cache_dir"). 
+    Entries are object files named by their content keys, optionally compressed with 
+    zlib. Entry is written to a temporary file and renamed, so readers never see 
+    partial entries, and builds storing the same entry at once just replace one 
+    complete file by another. Modification time of entry is time of its last use, 
+    least recently used entries are evicted when the cache is over its size limit.
+    """
+    def __init__(self, directory, sizeLimit, compression):
+        self.directory = directory
+        self.sizeLimit = sizeLimit
+        self.compression = compression
+        self.lock = threading.Lock()
+        self.counters = dict({"hits" : 0, "misses" : 0, "stored" : 0, "evicted" : 0})
+        os.makedirs(directory, exist_ok=True)
+
+    def count(self, name):
+        """Increments counter of cache events"""
+        with self.lock:
+            self.counters[name] = self.counters[name] + 1
+
+    def entryPath(self, name, compressed):
+        """Returns path of entry, entries are spread over subdirectories by first characters of key"""
+        path = os.path.join(self.directory, name[:2], name)
+        if compressed:
+            path = path + ".z"
+        return path
+
+    def temporaryName(self, path):
+        """Returns name of temporary file for path, unique for the host, process and thread"""
+        return path + "." + os.uname().nodename + "." + str(os.getpid()) + "." + str(threading.get_ident()) + ".tmp"
+
+    def fetch(self, localPath):
+        """Copies object from the cache to local path. Returns True if it was in the cache"""
+        import zlib
+
+        name = os.path.basename(localPath)
+        for compressed in [self.compression, not self.compression]:
+            entry = self.entryPath(name, compressed)
+            try:
+                f = open(entry, "rb")
+                data = f.read()
+                f.close()
+                if compressed:
+                    data = zlib.decompress(data)
+            except (OSError, zlib.error):
+                continue
+
+            tmpname = self.temporaryName(localPath)
+            f = open(tmpname, "wb")
+            f.write(data)
+            f.close()
+            os.replace(tmpname, localPath)
+            try:
+                os.utime(entry)
+            except OSError:
+                pass
+            self.count("hits")
+            return True
+
+        self.count("misses")
+        return False
+
+    def store(self, localPath):
+        """Stores object from local path in the cache, unless it is there already"""
+        import zlib
+
+        entry = self.entryPath(os.path.basename(localPath), self.compression)
+        try:
+            os.utime(entry)
+            return
+        except OSError:
+            pass
+
+        try:
+            f = open(localPath, "rb")
+            data = f.read()
+            f.close()
+            if self.compression:
+                data = zlib.compress(data, 1)
+            os.makedirs(os.path.dirname(entry), exist_ok=True)
+            tmpname = self.temporaryName(entry)
+            f = open(tmpname, "wb")
+            f.write(data)
+            f.close()
+            os.replace(tmpname, entry)
+        except OSError as e:
+            fastprint("Failed to store " + localPath + " in shared cache: " + str(e), level=2)
+            return
+        self.count("stored")
+
+    def entries(self):
+        """Returns list of (last use, size, path) of entries, and list of temporary files"""
+        entries = list()
+        temporary = list()
+        for (dirpath, dirnames, filenames) in os.walk(self.directory):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                if dirpath == self.directory:
+                    continue
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                if filename.endswith(".tmp"):
+                    temporary.append((st.st_mtime, st.st_size, path))
+                else:
+                    entries.append((st.st_mtime, st.st_size, path))
+        return entries, temporary
+
+    def evict(self):
+        """Removes least recently used entries until the cache is under 90% of its size 
+        limit, and temporary files left by interrupted builds.
+        """
+        if self.sizeLimit <= 0:
+            return
+        (entries, temporary) = self.entries()
+        for (mtime, size, path) in temporary:
+            if time.time() - mtime > 3600:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+        total = sum(size for (mtime, size, path) in entries)
+        if total <= self.sizeLimit:
+            return
+        for (mtime, size, path) in sorted(entries):
+            if total <= self.sizeLimit * 0.9:
+                break
+            #other build could evict or use the entry at the same time, it is just fetched as miss
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total = total - size
+            self.count("evicted")
+
+    def saveStats(self):
+        """Adds counters of this build to statistics of the cache and resets them"""
+        import fcntl
+
+        lockfile = open(os.path.join(self.directory, "stats.lock"), "a")
+        try:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            stats = readCacheStats(self.directory)
+            with self.lock:
+                for name in self.counters:
+                    stats.update({name : stats.get(name, 0) + self.counters[name]})
+                    self.counters[name] = 0
+            tmpname = self.temporaryName(os.path.join(self.directory, "stats.json"))
+            f = open(tmpname, "w")
+            json.dump(stats, f)
+            f.close()
+            os.replace(tmpname, os.path.join(self.directory, "stats.json"))
+        finally:
+            lockfile.close()
+
+
+def readCacheStats(directory):
+    """Reads statistics of shared cache directory"""
+    try:
+        f = open(os.path.join(directory, "stats.json"), "r")
+        stats = json.load(f)
+        f.close()
+    except (IOError, ValueError):
+        stats = dict()
+    return stats
+
+
+def openSharedCache(cfg):
+    """Opens shared object cache configured by "cache_dir", "cache_size" (MiB) 
+    and "cache_compression"
+    """
+    global sharedCache
+    sharedCache = None
+    if (not "cache_dir" in cfg.keys()) or (cfg["cache_dir"] == ""):
+        return
+
+    sizeLimit = 5120
+    if "cache_size" in cfg.keys():
+        sizeLimit = cfg["cache_size"]
+    compression = False
+    if "cache_compression" in cfg.keys():
+        compression = cfg["cache_compression"]
+    sharedCache = sharedObjectCache(os.path.expanduser(cfg["cache_dir"]), int(sizeLimit * 1024 * 1024), compression)
+
+
+def finishSharedCache():
+    """Evicts entries over size limit of shared cache and saves its statistics"""
+    if sharedCache == None:
+        return
+    counters = dict(sharedCache.counters)
+    if counters["stored"] > 0:
+        sharedCache.evict()
+        counters = dict(sharedCache.counters)
+    if sum(counters.values()) > 0:
+        fastprint("Shared cache: " + str(counters["hits"]) + " hits, " + str(counters["misses"]) + " misses, " 
+            + str(counters["stored"]) + " objects stored, " + str(counters["evicted"]) + " evicted.")
+        sharedCache.saveStats()
+
+
+def printCacheStats():
+    """Prints statistics of shared cache of config: hits and misses of all builds 
+    using it, number and size of entries.
+    """
+    cfg = getConfig()
+    openSharedCache(cfg)
+    if sharedCache == None:
+        fastprint("No shared cache configured (\"cache_dir\" in config).", level=2)
+        return
+
+    stats = readCacheStats(sharedCache.directory)
+    (entries, temporary) = sharedCache.entries()
+    hits = stats.get("hits", 0)
+    misses = stats.get("misses", 0)
+    size = sum(size for (mtime, size, path) in entries)
+
+    fastprint(bgcolors.BOLD + "\nShared cache " + sharedCache.directory + ":" + bgcolors.ENDC, level=1)
+    rate = ""
+    if hits + misses > 0:
+        rate = " (" + str(round(hits * 100.0 / (hits + misses), 1)) + "% hit rate)"
+    fastprint("  hits:     " + str(hits) + rate, level=1)
+    fastprint("  misses:   " + str(misses), level=1)
+    fastprint("  stored:   " + str(stats.get("stored", 0)), level=1)
+    fastprint("  evicted:  " + str(stats.get("evicted", 0)), level=1)
+    limit = "unlimited"
+    if sharedCache.sizeLimit > 0:
+        limit = str(round(sharedCache.sizeLimit / 1048576.0, 1)) + " MiB"
+    fastprint("  entries:  " + str(len(entries)) + ", " + str(round(size / 1048576.0, 1)) + " MiB of " + limit, level=1)
+
+
+def objectAvailable(path):
+    """Checks if object file is in the object cache, fetching it from the shared 
+    cache when it is configured
+    """
+    if os.path.exists(path):
+        return True
+    if (sharedCache == None) or rebuildall:
+        return False
+    return sharedCache.fetch(path)
+
+
+def parallelMap(function, items):
+    """Applies function to all items in up to threadLimit threads, returns 
+    list of results in order of items.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    if (threadLimit == 1) or (len(items) < 2):
+        return [function(item) for item in items]
+    with ThreadPoolExecutor(max_workers=threadLimit, thread_name_prefix="scan") as pool:
+        return list(pool.map(function, items))
+
+
+def hashFiles(paths):
+    """Calculates checksums of files in up to threadLimit threads, so they are 
+    taken from memo of the run later. Files which can not be read are skipped.
+    """
+    def checksumOrNone(path):
+        try:
+            return fileChecksum(path)
+        except IOError:
+            return None
+
+    with traceSpan("hash " + str(len(paths)) + " files", "hash"):
+        return parallelMap(checksumOrNone, paths)
+
+
+def generateChecksums(filetree):
+    """Generates a hash table with checksums for the project files so that 
+    the program can then find changes to the next build from the current one.
+    """
+
+    sums = dict()
+
+    paths = list(filetree.sourcePaths())
+    for dep in filetree.dependencyPaths():
+        paths.append(pathFromRoot(dep))
+    hashFiles(paths)
+
+    for source in filetree.sourcePaths():
+        sums.update({source : fileChecksum(source)})
+
+    for dep in filetree.dependencyPaths():
+        depheader = pathFromRoot(dep)
+        if depheader not in sums.keys():
+            sums.update({depheader : fileChecksum(depheader)})
+
+    buildState.update({"checksums" : sums})
+
+    #pprint.pprint(sums)
+
+
+def fileHasPregeneratedTree(filepath):
+    """Checks if file has a pregenerated dependency tree
+    If checksum of file is changed, dependecy tree is outdated and rebuild is needed
+    """
+    try:
+        checksumNew = fileChecksum(filepath)
+    except IOError:
+        return False
+    return checksumNew in dependencyTrees
+
+
+def resolveSourceDependencies(filename):
+    """Finds dependencies of the source: restores its dependency tree if it is 
+    pregenerated, or scans the file. Returns dependencies and True if the tree was restored.
+    """
+    if (not fileHasPregeneratedTree(filename)) or rebuildTree:
+        return findDependeciesInFile(filename, 1, recursionThreshold, list()), False
+    try:
+        deps = restorePregeneratedDependenciesForFile(filename)
+    except pregenerationError:
+        return findDependeciesInFile(filename, 1, recursionThreshold, list()), False
+    if not dependencyTreeIsCurrent(filename, deps):
+        global outdatedTreesCount
+        with scanStatsLock:
+            outdatedTreesCount = outdatedTreesCount + 1
+        return findDependeciesInFile(filename, 1, recursionThreshold, list()), False
+    return deps, True
+
+
+def dependencyTreeIsCurrent(filename, deps):
+    """Checks that restored dependency tree of the source contains everything the 
+    source and its dependencies include now. Tree is keyed by checksum of the source 
+    only, so it is outdated when some header starts including other files. Inclusions 
+    are taken from the cache by checksum of file content, files are not parsed again.
+    """
+    known = set(deps)
+    for path in [filename] + [pathFromRoot(dep) for dep in deps]:
+        if not os.path.isfile(path):
+            return False
+        directory = ""
+        if path.rfind("/") != -1:
+            directory = path[0 : path.rfind("/")]
+        for dependency in getDirectIncludes(path):
+            if resolveRelativePath(dependency, directory) not in known:
+                return False
+    return True
+
+
+def restorePregeneratedDependenciesForFile(filepath):
+    """Reads pregenerated dependency tree for specified file"""
+    try:
+        checksumNew = fileChecksum(filepath)
+    except IOError:
+        fastprint("Error reading file " + filepath + "!")
+        raise pregenerationError("File Error")
+
+    if checksumNew not in dependencyTrees:
+        raise pregenerationError("Tree Error")
+
+    usedDependencyTrees.add(checksumNew)
+    return dependencyTrees[checksumNew]
+
+
+def terminateChildren():
+    """Terminates all running commands started by callWithRusage (with their children)"""
+    with runningChildrenLock:
+        for pid in runningChildren:
+            try:
+                os.killpg(pid, signal.SIGTERM)
+            except OSError:
+                continue
+
+
+def callWithRusage(shellcmd, captured=None):
+    """Runs shell command and returns its exit status, wall time, user and system CPU 
+    time and peak resident set size (in KiB), taken from rusage of the child process.
+    If captured list is given, output of the command is appended to it instead of printing.
+    Command runs in its own process group, so it can be terminated with its children. 
+    Command given as list of arguments is run without shell.
+    """
+    start = time.time()
+    shell = isinstance(shellcmd, str)
+    if captured == None:
+        child = Popen(shellcmd, shell=shell, start_new_session=True)
+    else:
+        child = Popen(shellcmd, shell=shell, stdout=PIPE, stderr=STDOUT, start_new_session=True)
+    with runningChildrenLock:
+        runningChildren.add(child.pid)
+    try:
+        if captured != None:
+            captured.append(child.stdout.read())
+        (pid, status, usage) = os.wait4(child.pid, 0)
+    except KeyboardInterrupt:
+        os.killpg(child.pid, signal.SIGTERM)
+        raise
+    finally:
+        with runningChildrenLock:
+            runningChildren.discard(child.pid)
+    child.returncode = os.waitstatus_to_exitcode(status)
+    end = time.time()
+    return child.returncode, end - start, usage.ru_utime, usage.ru_stime, usage.ru_maxrss
+
+
+def recordMetrics(kind, name, wall, user, system, rss):
+    """Appends sample to the history of compile ("compile") or link ("link") metrics, 
+    only last metricsHistoryLength samples of each target are kept.
+    """
+    sample = [round(wall, 3), round(user, 3), round(system, 3), rss, int(time.time())]
+    with buildMetricsLock:
+        history = buildMetrics[kind].get(name, list())
+        history.append(sample)
+        buildMetrics[kind].update({name : history[-1 * metricsHistoryLength:]})
+
+
+def lastCompileTime(target):
+    """Returns wall time of last successful compile of target, or None if it is unknown"""
+    history = buildMetrics["compile"].get(target)
+    if not history:
+        return None
+    return history[-1][0]
+
+
+def loadBuildMetrics():
+    """Loads compile and link metrics recorded by previous builds from build state"""
+    global buildMetrics
+    buildMetrics = dict({"compile" : dict(), "link" : dict()})
+    for target in buildState["metrics"]:
+        (kind, name) = target.split("/", 1)
+        if kind in buildMetrics:
+            buildMetrics[kind].update({name : buildState["metrics"][target]})
+
+
+def currentMetricsTargets():
+    """Returns names of compile and link targets of the build: sources, unity batches, 
+    precompiled headers, pre-linked macrotargets and products. Returns None if the 
+    build stopped before all of them were known.
+    """
+    if ("cfg" not in buildContext) or ("finaldependency" not in buildContext):
+        return None
+    cfg = buildContext["cfg"]
+
+    compiles = set(objectKeys.keys())
+    for plan in precompiledPlans:
+        compiles.add("pch:" + plan["name"])
+
+    links = set(["prelink:" + mt for mt in cfg["macrotargets"]])
+    products = buildProducts(cfg)
+    for mt in products:
+        links.add(products[mt]["output"])
+    if len(products) < len(cfg["macrotargets"]):
+        links.add(cfg["linker_output_file"])
+    return dict({"compile" : compiles, "link" : links})
+
+
+def saveBuildMetrics():
+    """Saves compile and link metrics to build state for scheduling, ETA and --stats report. 
+    Metrics of targets which are not part of the build anymore (deleted or renamed 
+    sources, outdated precompiled headers, removed products) are dropped.
+    """
+    current = currentMetricsTargets()
+    metrics = dict()
+    with buildMetricsLock:
+        for kind in buildMetrics:
+            for name in list(buildMetrics[kind].keys()):
+                if (current != None) and (name not in current[kind]):
+                    del buildMetrics[kind][name]
+                    continue
+                metrics.update({kind + "/" + name : buildMetrics[kind][name]})
+    buildState.update({"metrics" : metrics})
+
+
+def formatSeconds(seconds):
+    """Formats time interval for progress output"""
+    seconds = int(round(seconds))
+    if seconds < 60:
+        return str(seconds) + "s"
+    return str(seconds // 60) + "m" + str(seconds % 60).zfill(2) + "s"
+
+
+def progressString(target):
+    """Marks microtarget as done and returns progress string with estimated time 
+    of arrival, based on expected costs of remaining jobs and actual speed so far.
+    """
+    with buildMetricsLock:
+        buildProgress["done"] = buildProgress["done"] + 1
+        buildProgress["estimatedDone"] = buildProgress["estimatedDone"] + jobCosts.get(target, 0.0)
+        done = buildProgress["done"]
+        total = buildProgress["total"]
+        estimatedDone = buildProgress["estimatedDone"]
+
+    progress = "[" + str(done) + "/" + str(total)
+    estimatedTotal = sum(jobCosts.values())
+    if (estimatedDone > 0) and (done < total):
+        elapsed = time.time() - buildProgress["start"]
+        eta = elapsed * (estimatedTotal - estimatedDone) / estimatedDone
+        progress = progress + ", ETA " + formatSeconds(eta)
+    return progress + "]"
+
+
+def parseDepfile(filename):
+    """Reads make-style dependency file written by compiler (-MMD -MF) and returns 
+    list of prerequisites of its first rule, as they are spelled in the file.
+    """
+    f = open(filename, 'r')
+    deptxt = f.read().replace("\\\n", " ")
+    f.close()
+
+    colon = deptxt.find(": ")
+    if colon == -1:
+        colon = deptxt.find(":\n")
+    if colon == -1:
+        return list()
+    rule = deptxt[colon + 1:].split("\n")[0]
+
+    prerequisites = list()
+    current = ""
+    i = 0
+    while i < len(rule):
+        char = rule[i]
+        if (char == "\\") and (i + 1 < len(rule)) and (rule[i + 1] in " #"):
+            current = current + rule[i + 1]
+            i = i + 1
+        elif (char == "$") and (i + 1 < len(rule)) and (rule[i + 1] == "$"):
+            current = current + "$"
+            i = i + 1
+        elif char in " \t":
+            if current != "":
+                prerequisites.append(current)
+            current = ""
+        else:
+            current = current + char
+        i = i + 1
+    if current != "":
+        prerequisites.append(current)
+
+    return prerequisites
+
+
+def harvestDependencies(target, depfile):
+    """Feeds dependencies reported by compiler for the microtarget into dependency 
+    cache, in place of dependencies found by the text scanner. Object key of the 
+    target is recalculated from them; new key is returned. Headers taken from 
+    precompiled header are not reported by compiler, they are added from its closure.
+    """
+    try:
+        prerequisites = parseDepfile(depfile)
+        os.remove(depfile)
+    except IOError:
+        return objectKeys[target]
+
+    source = resolveRelativePath(target)
+    deps = list()
+    for prerequisite in prerequisites:
+        dep = resolveRelativePath(prerequisite)
+        if (dep != source) and (dep not in deps):
+            deps.append(dep)
+    for dep in precompiledClosures.get(target, list()):
+        if dep not in deps:
+            deps.append(dep)
+
+    checksum = fileChecksum(target)
+    dependencyTrees.update({checksum : deps})
+    usedDependencyTrees.add(checksum)
+
+    #key is stored in build state too, next run compares keys with the object actually built
+    key = calculateObjectKey(target, deps)
+    with buildMetricsLock:
+        harvestedDependencies.update({target : deps})
+        objectKeys.update({target : key})
+        buildState["objects"].update({target : key})
+    return key
+
+
+def openSocket(address):
+    """Creates socket for worker address: "unix:/path" for Unix socket or "host:port" for TCP.
+    Returns socket and address in form accepted by it.
+    """
+    import socket
+
+    if address.startswith("unix:"):
+        return socket.socket(socket.AF_UNIX, socket.SOCK_STREAM), address[5:]
+    (host, port) = address.rsplit(":", 1)
+    return socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET, socket.SOCK_STREAM), (host.strip("[]"), int(port))
+
+
+def sendFrame(sock, data):
+    """Sends one frame of worker protocol: 4-byte big-endian length and data"""
+    import struct
+
+    sock.sendall(struct.pack(">I", len(data)) + data)
+
+
+def receiveFrame(sock):
+    """Receives one frame of worker protocol, returns None if connection was closed"""
+    import struct
+
+    def receiveExactly(size):
+        data = b""
+        while len(data) < size:
+            chunk = sock.recv(min(size - len(data), 1048576))
+            if len(chunk) == 0:
+                return None
+            data = data + chunk
+        return data
+
+    header = receiveExactly(4)
+    if header == None:
+        return None
+    return receiveExactly(struct.unpack(">I", header)[0])
+
+
+def checkWorkerJob(job):
+    """Worker side check of the job: compiler must be a bare name from workerCompilers, 
+    found on PATH of the worker, of the same version as on coordinator, and parameters 
+    must not run other programs or write other files. Returns path of compiler binary 
+    and None, or None and the reason of rejection.
+    """
+    argv = shlex.split(job["compiler"])
+    if (len(argv) != 1) or (argv[0] not in workerCompilers):
+        return None, "compiler is not allowed on worker: " + job["compiler"]
+    binary = shutil.which(argv[0])
+    if binary == None:
+        return None, "compiler is not found on worker: " + argv[0]
+
+    for param in shlex.split(job["params"]):
+        for denied in workerDeniedParams:
+            if param.startswith(denied):
+                return None, "parameter is not allowed on worker: " + param
+
+    with buildMetricsLock:
+        version = workerCompilerVersions.get(binary)
+    if version == None:
+        child = Popen([binary, "--version"], stdin=PIPE, stdout=PIPE, stderr=PIPE)
+        version = hashlib.md5(child.communicate()[0]).hexdigest()
+        with buildMetricsLock:
+            workerCompilerVersions.update({binary : version})
+    if version != job.get("version"):
+        return None, "compiler version on worker differs from coordinator: " + argv[0]
+    return binary, None
+
+
+def serveCompileJobs(connection, slots):
+    """Worker side of one connection: receives jobs (JSON header frame and preprocessed 
+    source frame), compiles them when a slot is free and sends back result header 
+    and object file frames, until the coordinator closes connection.
+    """
+    import tempfile
+
+    try:
+        while True:
+            header = receiveFrame(connection)
+            if header == None:
+                return
+            source = receiveFrame(connection)
+            if source == None:
+                return
+            job = json.loads(header.decode('utf-8'))
+
+            (binary, rejection) = checkWorkerJob(job)
+            result = {"status" : 1, "output" : "", "wall" : 0.0, "user" : 0.0, "system" : 0.0, "rss" : 0}
+            obj = b""
+            if binary == None:
+                result.update({"rejected" : rejection})
+            else:
+                with slots:
+                    workdir = tempfile.mkdtemp(prefix="fastbuild-worker-")
+                    try:
+                        sourcePath = os.path.join(workdir, "source" + job["suffix"])
+                        objPath = os.path.join(workdir, "source.o")
+                        f = open(sourcePath, "wb")
+                        f.write(source)
+                        f.close()
+                        captured = list()
+                        (ret, wall, user, system, rss) = callWithRusage([binary] + shlex.split(job["params"]) 
+                            + ["-c", sourcePath, "-o", objPath], captured)
+                        result.update({"status" : ret, "output" : captured[0].decode('utf-8', 'replace'), 
+                            "wall" : wall, "user" : user, "system" : system, "rss" : rss})
+                        if ret == 0:
+                            try:
+                                f = open(objPath, "rb")
+                                obj = f.read()
+                                f.close()
+                            except IOError:
+                                result.update({"status" : 1, "output" : result["output"] + "compiler did not write object file\n"})
+                    finally:
+                        shutil.rmtree(workdir, ignore_errors=True)
+
+            sendFrame(connection, json.dumps(result).encode('utf-8'))
+            sendFrame(connection, obj)
+    except (OSError, ValueError, KeyError):
+        return
+    finally:
+        connection.close()
+
+
+def runWorker(address, slotsCount):
+    """Worker agent mode: accepts compile jobs of fastbuild coordinators over TCP or Unix 
+    socket and compiles up to slotsCount of them at once. Worker runs only compilers 
+    from workerCompilers list, without shell, but it must be used only in trusted networks.
+    """
+    import socket
+
+    (server, bindAddress) = openSocket(address)
+    if address.startswith("unix:") and os.path.exists(bindAddress):
+        os.remove(bindAddress)
+    else:
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(bindAddress)
+    server.listen(64)
+
+    slots = threading.BoundedSemaphore(slotsCount)
+    fastprint("Fastbuild worker listening on " + address + " with " + str(slotsCount) + " slots", level=1)
+    try:
+        while True:
+            (connection, peer) = server.accept()
+            threading.Thread(target=serveCompileJobs, args=(connection, slots), daemon=True).start()
+    except KeyboardInterrupt:
+        fastprint("\nWorker stopped.", level=1)
+    finally:
+        server.close()
+
+
+class remoteWorker:
+    """Coordinator side of a worker agent: its address, number of slots and state. 
+    Worker which failed once is not used till the end of the build.
+    """
+    def __init__(self, address, slots):
+        self.address = address
+        self.slots = slots
+        self.alive = True
+
+    def connect(self):
+        """Opens connection to the worker"""
+        (sock, connectAddress) = openSocket(self.address)
+        sock.settimeout(10)
+        sock.connect(connectAddress)
+        sock.settimeout(3600)
+        return sock
+
+
+def compileRemotely(worker, connection, target, localCompiler, params, temporaryObjPath):
+    """Preprocesses the microtarget locally and compiles it on the worker. Returns
+    compile result like callWithRusage and captured output, or None if the worker failed.
+    """
+    suffix = ".ii"
+    if headerLanguage(localCompiler, target) == "c-header":
+        suffix = ".i"
+    preprocessed = temporaryObjPath + suffix
+
+    preprocessShell = localCompiler + " " + params + " -E " + shlex.quote(target) + " -o " + preprocessed
+    if compilerDependencies and (target not in unityBatches):
+        preprocessShell = preprocessShell + " -MMD -MF " + temporaryObjPath + ".d"
+    captured = list()
+    (ret, wall, user, system, rss) = callWithRusage(preprocessShell, captured)
+    if ret != 0:
+        if os.path.exists(preprocessed):
+            os.remove(preprocessed)
+        return (ret, wall, user, system, rss), captured[0]
+
+    try:
+        source = open(preprocessed, "rb").read()
+    finally:
+        os.remove(preprocessed)
+
+    #worker rejects jobs for other compiler version, its objects would be stored under local keys
+    version = getCompilerIdentity(localCompiler).split(" ")[-1]
+    job = {"compiler" : localCompiler, "params" : params, "suffix" : suffix, "version" : version}
+    try:
+        sendFrame(connection, json.dumps(job).encode('utf-8'))
+        sendFrame(connection, source)
+        header = receiveFrame(connection)
+        obj = receiveFrame(connection)
+        if (header == None) or (obj == None):
+            raise OSError("connection closed by worker")
+        result = json.loads(header.decode('utf-8'))
+    except (OSError, ValueError) as e:
+        fastprint("Worker " + worker.address + " failed (" + str(e) + "), falling back to local build", level=2)
+        worker.alive = False
+        return None
+
+    if "rejected" in result:
+        fastprint("Worker " + worker.address + " rejected job (" + result["rejected"] + "), falling back to local build", level=2)
+        worker.alive = False
+        return None
+
+    if result["status"] == 0:
+        f = open(temporaryObjPath, "wb")
+        f.write(obj)
+        f.close()
+    return (result["status"], result["wall"], result["user"], result["system"], result["rss"]), captured[0] + result["output"].encode('utf-8')
+
+
+def detectCpuCount():
+    """Returns number of CPUs available to fastbuild, respecting CPU affinity 
+    and cgroup CPU quota (v2 and v1).
+    """
+    try:
+        count = len(os.sched_getaffinity(0))
+    except (AttributeError, OSError):
+        count = os.cpu_count() or 1
+
+    quotas = [("/sys/fs/cgroup/cpu.max", None), 
+        ("/sys/fs/cgroup/cpu/cpu.cfs_quota_us", "/sys/fs/cgroup/cpu/cpu.cfs_period_us")]
+    for (quotaFile, periodFile) in quotas:
+        try:
+            values = open(quotaFile, "r").read().split()
+            if periodFile != None:
+                values.append(open(periodFile, "r").read().strip())
+        except IOError:
+            continue
+        if (len(values) >= 2) and (values[0] not in ["max", "-1"]):
+            count = min(count, max(1, -(-int(values[0]) // int(values[1]))))
+            break
+
+    return count
+
+
+def readMemoryInfo():
+    """Returns total and available memory of the system in KiB, or None if it is unknown"""
+    try:
+        meminfo = open("/proc/meminfo", "r").read()
+    except IOError:
+        return None
+    values = dict()
+    for line in meminfo.split("\n"):
+        fields = line.split()
+        if len(fields) >= 2:
+            values.update({fields[0].rstrip(":") : int(fields[1])})
+    if ("MemTotal" not in values) or ("MemAvailable" not in values):
+        return None
+    return values["MemTotal"], values["MemAvailable"]
+
+
+class admissionControl:
+    """Holds back start of new local compiles while used memory or load average of the 
+    system is over the limits. Every job is expected to take as much memory as at its 
+    last compile (peak RSS from metrics), so heavy jobs count more. At least one job 
+    is always admitted, so the build can not stall.
+    """
+    def __init__(self, memoryPercent, loadLimit):
+        self.memoryPercent = memoryPercent
+        self.loadLimit = loadLimit
+        self.condition = threading.Condition()
+        self.running = dict()
+        self.heldBack = 0
+
+        known = [history[-1][3] for history in buildMetrics["compile"].values() if len(history) > 0]
+        self.defaultRss = 0
+        if len(known) > 0:
+            self.defaultRss = median(known)
+
+    def expectedRss(self, target):
+        """Returns expected peak memory of compile of the target in KiB"""
+        history = buildMetrics["compile"].get(target)
+        if not history:
+            return self.defaultRss
+        return history[-1][3]
+
+    def overLimits(self, expected):
+        """Checks if starting a job with expected peak memory would exceed the limits"""
+        if (self.loadLimit > 0) and (os.getloadavg()[0] > self.loadLimit):
+            return True
+
+        memory = readMemoryInfo()
+        if (self.memoryPercent > 0) and (memory != None):
+            (total, available) = memory
+            #jobs started just now did not grow to their peak yet, their expected memory is reserved
+            reserved = sum(rss for (rss, started) in self.running.values() if time.time() - started < 2.0)
+            if (total - available + reserved + expected) * 100 > total * self.memoryPercent:
+                return True
+
+        return False
+
+    def acquire(self, target):
+        """Waits until the job may start"""
+        expected = self.expectedRss(target)
+        with self.condition:
+            held = False
+            while (len(self.running) > 0) and self.overLimits(expected):
+                if not held:
+                    held = True
+                    self.heldBack = self.heldBack + 1
+                self.condition.wait(0.25)
+            self.running.update({target : (expected, time.time())})
+
+    def release(self, target):
+        """Marks the job finished"""
+        with self.condition:
+            if target in self.running:
+                del self.running[target]
+            self.condition.notify_all()
+
+
+def microtargetBuilder(jobQueue, localCompiler, localCParams, localLParams, threadNumber, worker=None):
+    """Worker body: takes microtargets from the shared job queue one by one and builds 
+    them, until the queue is empty and no more sources are pending (pipelined build). 
+    Wall time, CPU time and peak memory of each compile are recorded to the metrics 
+    store. Thread bound to a remote worker sends jobs to it while it works. When the 
+    worker fails, the thread puts its job back to the queue and ends, so local threads 
+    build it and no more than threadLimit compiles run locally.
+    """
+    global failmarker
+    global remoteJobsHeld
+    connection = None
+    while True:
+        if (worker != None) and (not worker.alive):
+            if connection != None:
+                connection.close()
+            return
+
+        #job taken by remote slot is counted at once, local threads wait for it while it can come back
+        if worker != None:
+            with buildMetricsLock:
+                remoteJobsHeld = remoteJobsHeld + 1
+        try:
+            if buildCancelled.is_set():
+                raise queue.Empty()
+            if sourcesPending.is_set() or ((worker == None) and (remoteJobsHeld > 0)):
+                target = jobQueue.get(timeout=0.1)
+            else:
+                target = jobQueue.get_nowait()
+        except queue.Empty:
+            if worker != None:
+                with buildMetricsLock:
+                    remoteJobsHeld = remoteJobsHeld - 1
+            #in pipelined build jobs are queued while sources are still being scanned
+            if (sourcesPending.is_set() or (not jobQueue.empty()) or ((worker == None) and (remoteJobsHeld > 0))) and (not buildCancelled.is_set()):
+                continue
+            if connection != None:
+                connection.close()
+            return
+
+        targetObjName = objectKeys[target]
+        targetObjPath = objectPath(target)
+        temporaryObjPath = targetObjPath + "." + str(os.getpid()) + "." + str(threadNumber) + ".tmp"
+        compilerShell = localCompiler + " " + localCParams + " " + localLParams + " -c " + shlex.quote(target) + " -o " + temporaryObjPath
+        if target in precompiledHeaders:
+            compilerShell = compilerShell + " " + precompiledHeaders[target]
+        if compilerDependencies and (target not in unityBatches):
+            compilerShell = compilerShell + " -MMD -MF " + temporaryObjPath + ".d"
+        #fastprint(compilerShell)
+
+        global runningCompiles
+        with buildMetricsLock:
+            runningCompiles = runningCompiles + 1
+            traceCounter("compiles", {"running" : runningCompiles})
+        compileStart = time.time()
+
+        result = None
+        location = "in thread #" + str(threadNumber)
+        if (worker != None) and worker.alive:
+            try:
+                if connection == None:
+                    connection = worker.connect()
+                remote = compileRemotely(worker, connection, target, localCompiler, localCParams + " " + localLParams, temporaryObjPath)
+            except OSError as e:
+                fastprint("Worker " + worker.address + " is not available (" + str(e) + "), falling back to local build", level=2)
+                worker.alive = False
+                remote = None
+            if remote != None:
+                (result, output) = remote
+                location = "on worker " + worker.address
+            elif connection != None:
+                connection.close()
+                connection = None
+
+        if worker != None:
+            if result == None:
+                jobQueue.put(target)
+            with buildMetricsLock:
+                remoteJobsHeld = remoteJobsHeld - 1
+                if result == None:
+                    runningCompiles = runningCompiles - 1
+                    traceCounter("compiles", {"running" : runningCompiles})
+            if result == None:
+                continue
+
+        if result == None:
+            captured = list()
+            admission.acquire(target)
+            try:
+                result = callWithRusage(compilerShell, captured)
+            finally:
+                admission.release(target)
+            output = captured[0]
+        (ret, wall, user, system, rss) = result
+        progress = progressString(target)
+
+        traceComplete("compile " + target, "compile", compileStart, time.time() - compileStart, 
+            {"status" : ret, "location" : location, "user" : user, "system" : system, "maxrss" : rss})
+        with buildMetricsLock:
+            runningCompiles = runningCompiles - 1
+            traceCounter("compiles", {"running" : runningCompiles})
+
+        #object is stored under its key only when compiled successfully
+        if ret == 0:
+            if compilerDependencies and (target not in unityBatches):
+                targetObjName = harvestDependencies(target, temporaryObjPath + ".d")
+                targetObjPath = objectPath(target)
+            os.replace(temporaryObjPath, targetObjPath)
+            if sharedCache != None:
+                sharedCache.store(targetObjPath)
+        else:
+            for leftover in [temporaryObjPath, temporaryObjPath + ".d"]:
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+        
+        if (ret != 0) and buildCancelled.is_set() and (ret < 0):
+            status = "[cancelled]"
+            output = b""
+        elif(ret != 0):
+            failmarker = True
+            status = "[failed]"
+            #without --keep-going no new jobs are started after the first error
+            if failureMode != "keep-going":
+                buildCancelled.set()
+            if failureMode == "fail-fast":
+                terminateChildren()
+        else:
+            recordMetrics("compile", target, wall, user, system, rss)
+            status = "[Successful in " + str(round(wall, 2)) + " seconds]"
+
+        #output of every job is printed at once, together with its status line
+        with printLock:
+            fastprint(progress + " ["+localCompiler+"] Compile " + target + " (object id: "+targetObjName+") " 
+                + status + " " + location)
+            if len(output) > 0:
+                sys.stdout.flush()
+                sys.stderr.write(output.decode('utf-8', 'replace'))
+                sys.stderr.flush()
+
+
+def estimateCompileHeuristic(target, deps):
+    """Estimates relative compile cost of microtarget by size of the source file 
+    and number and size of files it includes.
+    """
+    cost = 0
+    for dep in deps:
+        try:
+            cost = cost + os.path.getsize(pathFromRoot(dep))
+        except OSError:
+            continue
+    try:
+        cost = cost + os.path.getsize(target)
+    except OSError:
+        pass
+    return cost + 1024 * len(deps)
+
+
+def scheduleBuildList(globalBuildlist, deps):
+    """Creates shared job queue for builder threads. Recently modified sources go 
+    first, other jobs are ordered longest expected job first: past compile time is used 
+    when it is known, otherwise a heuristic (file size and transitive includes) is 
+    scaled to seconds using files which have both.
+    """
+    heuristics = dict()
+    for target in globalBuildlist:
+        if target in unityBatches:
+            cost = sum(estimateCompileHeuristic(member, deps.dependenciesOf(member)) for member in unityBatches[target])
+        else:
+            cost = estimateCompileHeuristic(target, deps.dependenciesOf(target))
+        heuristics.update({target : cost})
+
+    knownTime = 0.0
+    knownHeuristic = 0
+    for target in heuristics:
+        if lastCompileTime(target) != None:
+            knownTime = knownTime + lastCompileTime(target)
+            knownHeuristic = knownHeuristic + heuristics[target]
+
+    scale = 1.0
+    if knownHeuristic > 0:
+        scale = knownTime / knownHeuristic
+
+    jobCosts.clear()
+    for target in heuristics:
+        if lastCompileTime(target) != None:
+            jobCosts.update({target : lastCompileTime(target)})
+        else:
+            jobCosts.update({target : heuristics[target] * scale})
+
+    buildProgress.update({"done" : 0, "total" : len(globalBuildlist), "estimatedDone" : 0.0, "start" : time.time()})
+
+    #sources modified recently (the ones being edited) go first, newest first, so their 
+    #errors are shown at once, other jobs are ordered longest first
+    now = time.time()
+    recency = dict()
+    for target in globalBuildlist:
+        try:
+            modified = max(os.path.getmtime(member) for member in unityBatches.get(target, [target]))
+        except OSError:
+            modified = 0
+        if now - modified > recentModificationWindow:
+            modified = 0
+        recency.update({target : modified})
+
+    jobQueue = queue.Queue()
+    for target in sorted(globalBuildlist, key=lambda t: (recency[t], jobCosts[t]), reverse=True):
+        jobQueue.put(target)
+
+    return jobQueue
+
+
+def median(values):
+    """Returns median of the list of numbers"""
+    ordered = sorted(values)
+    middle = len(ordered) // 2
+    if len(ordered) % 2 == 1:
+        return ordered[middle]
+    return (ordered[middle - 1] + ordered[middle]) / 2
+
+
+def printStatsReport(limit=20):
+    """Prints report from the metrics store: slowest translation units, translation 
+    units whose last compile time regressed against their history, and link times.
+    """
+    if (not os.path.exists("fastbuild/state.db")) and (not os.path.exists("fastbuild/metrics.json")):
+        fastprint("No metrics recorded yet. Run fastbuild to collect them.", level=2)
+        return
+
+    openBuildState()
+    compiles = buildMetrics["compile"]
+
+    if len(compiles) == 0:
+        fastprint("No metrics recorded yet. Run fastbuild to collect them.", level=2)
+        return
+
+    fastprint(bgcolors.BOLD + "\nSlowest translation units (last compile):" + bgcolors.ENDC, level=1)
+    fastprint("   wall(s)   user(s)    sys(s)  peak RSS(MiB)  file", level=1)
+    slowest = sorted(compiles, key=lambda t: compiles[t][-1][0], reverse=True)
+    for target in slowest[:limit]:
+        sample = compiles[target][-1]
+        fastprint(str(sample[0]).rjust(10) + str(sample[1]).rjust(10) + str(sample[2]).rjust(10) 
+            + str(round(sample[3] / 1024, 1)).rjust(15) + "  " + target, level=1)
+
+    fastprint(bgcolors.BOLD + "\nRegressed translation units (last compile vs median of history):" + bgcolors.ENDC, level=1)
+    regressions = list()
+    for target in compiles:
+        history = compiles[target]
+        if len(history) < 2:
+            continue
+        previous = median([sample[0] for sample in history[:-1]])
+        last = history[-1][0]
+        if (last > previous * 1.2) and (last - previous > 0.1):
+            regressions.append((target, previous, last))
+
+    if len(regressions) == 0:
+        fastprint("No regressions detected.", level=1)
+    for (target, previous, last) in sorted(regressions, key=lambda r: r[2] - r[1], reverse=True)[:limit]:
+        fastprint(bgcolors.WARNING + "  " + str(round(previous, 2)) + "s -> " + str(round(last, 2)) + "s (+" 
+            + str(int(round((last / previous - 1) * 100))) + "%)  " + target + bgcolors.ENDC, level=1)
+
+    fastprint(bgcolors.BOLD + "\nLink times:" + bgcolors.ENDC, level=1)
+    for output in buildMetrics["link"]:
+        sample = buildMetrics["link"][output][-1]
+        fastprint("  " + str(sample[0]) + "s wall, " + str(round(sample[3] / 1024, 1)) + " MiB peak RSS  " + output, level=1)
+
+
+def printDependencyStats(filescount, restoredNodesCount, outdatedNodesCount):
+    """Cleans up dependency trees not used by this build and prints 
+    statistics of dependency resolution.
+    """
+    deletedFiles = 0
+    for checksum in list(dependencyTrees.keys()):
+        if checksum not in usedDependencyTrees:
+            del dependencyTrees[checksum]
+            deletedFiles = deletedFiles + 1
+
+    fastprint("\nDependency tree: "+str(filescount)+" nodes total, "+str(restoredNodesCount)
+        +" nodes restored, "+str(outdatedNodesCount)+" nodes out of date.")
+    fastprint("Dependency tree: "+str(len(usedDependencyTrees))+" nodes in use, "
+        +str(deletedFiles)+" nodes cleaned up.")
+    fastprint("Path resolver: "+str(resolveCacheHits)+" cache hits, "
+        +str(resolveLookups)+" filesystem lookups.")
+    fastprint("Header cache: "+str(includesParsedCount)+" files parsed, "+str(includesRestoredCount)
+        +" files restored, "+str(closuresReusedCount)+" sub-graphs reused.")
+    if outdatedTreesCount > 0:
+        fastprint("Dependency tree: "+str(outdatedTreesCount)+" restored nodes outdated by changed includes, rescanned.")
+
+
+def resolveMacrotargets(cfg):
+    """Resolves file lists of all macrotargets of config. Returns dictionary 
+    macrotarget -> list of files and total number of files.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    finalfiles = dict()
+    filescount = 0
+    targetscount = len(cfg["macrotargets"])
+    j = 0
+
+    #independent macrotargets are resolved concurrently, results are merged in config order
+    with ThreadPoolExecutor(max_workers=max(threadLimit, 4), thread_name_prefix="glob") as pool:
+        resolving = list()
+        for macrotarget in cfg["macrotargets"]:
+            resolving.append((macrotarget, pool.submit(resolveMacrotargetFiles, macrotargetPatterns(cfg["macrotargets"][macrotarget]))))
+
+        for (macrotarget, future) in resolving:
+            (src, emptyPatterns) = future.result()
+            for pattern in emptyPatterns:
+                fastprint(bgcolors.WARNING + "Warning: \"" + pattern + "\" of macrotarget \"" + macrotarget 
+                    + "\" matches no files." + bgcolors.ENDC, level=1)
+            filescount = filescount + len(src)
+            j = j + 1
+            fastprint("[" + str(int(round((j / targetscount) * 100 ))) + "%] In Progress...", fastend="\r", level=1)
+            finalfiles.update({macrotarget: src})
+
+    saveGlobCache()
+    fastprint("[100%] Done!              ", level=1)
+    return finalfiles, filescount
+
+
+def headerLanguage(compiler, source):
+    """Returns language of precompiled header which can be used for the source"""
+    if compiler.split()[0].endswith("++") or (not source.endswith(".c")):
+        return "c++-header"
+    return "c-header"
+
+
+def selectPrecompiledHeaders(sources, deps, threshold):
+    """Selects headers included by at least threshold part of the sources, in order 
+    of their inclusion. Headers included by other selected headers are left out, 
+    they get into precompiled header through the ones including them.
+    """
+    counts = dict()
+    order = dict()
+    for source in sources:
+        for position, dep in enumerate(deps.dependenciesOf(source)):
+            counts.update({dep : counts.get(dep, 0) + 1})
+            order.update({dep : min(order.get(dep, position), position)})
+
+    selected = [dep for dep in counts if counts[dep] >= max(2, threshold * len(sources))]
+    selected.sort(key=lambda dep: order[dep])
+
+    nested = set()
+    for dep in selected:
+        (closure, lowest) = collectDependencies(pathFromRoot(dep), dep, 1, recursionThreshold, dict())
+        nested.update(closure)
+
+    return [dep for dep in selected if dep not in nested]
+
+
+def leadingIncludes(filename):
+    """Returns headers (resolved as dependencies) included by the first directives of 
+    the file, before any other code. Only these headers can be taken from precompiled 
+    header, macros defined before an inclusion would be lost in it.
+    """
+    import re
+
+    try:
+        f = open(filename, "rb")
+        filetxt = f.read().decode(systemEncoding, errors="replace")
+        f.close()
+    except IOError:
+        return list()
+
+    directory = ""
+    if filename.rfind("/") != -1:
+        directory = filename[0 : filename.rfind("/")]
+
+    includes = list()
+    for line in re.sub(r"/\*.*?\*/", " ", filetxt, flags=re.S).split("\n"):
+        line = line.split("//")[0].strip()
+        if line == "":
+            continue
+        match = re.match(r'#\s*include\s*"([^"]+)"$', line)
+        if match == None:
+            break
+        includes.append(resolveRelativePath(match.group(1), directory))
+    return includes
+
+
+def precompiledHeaderPlan(compiler, headers, language):
+    """Returns plan of precompiled header of the headers list: its key (compiler, flags 
+    and contents of the headers with all their dependencies), prefix header and binary 
+    names, compiler arguments to use it and list of the headers with their dependencies. 
+    Returns None if some of them can not be read.
+    """
+    closure = list()
+    for header in headers:
+        if header not in closure:
+            closure.append(header)
+        (deps, lowest) = collectDependencies(pathFromRoot(header), header, 1, recursionThreshold, dict())
+        for dep in deps:
+            if dep not in closure:
+                closure.append(dep)
+
+    key = hashlib.md5()
+    key.update((objectKeyPrefix + language + "\n" + "\n".join(headers) + "\n").encode('utf-8'))
+    for dep in sorted(closure):
+        try:
+            key.update((dep + ":" + fileChecksum(pathFromRoot(dep)) + "\n").encode('utf-8'))
+        except IOError:
+            return None
+    name = "fastbuild/pch/" + key.hexdigest() + ".h"
+
+    clang = "clang" in compiler.split()[0]
+    if clang:
+        binary = name + ".pch"
+        arguments = "-include-pch " + binary
+    else:
+        binary = name + ".gch"
+        arguments = "-include " + name
+
+    return dict({"key" : key.hexdigest(), "name" : name, "binary" : binary, "arguments" : arguments, 
+        "closure" : closure, "headers" : headers, "language" : language})
+
+
+def buildPrecompiledHeader(compiler, params, plan):
+    """Builds precompiled header of the plan, unless it was built before: header is 
+    named by its key, so it is built again only when one of its headers changes. 
+    Returns False if failed.
+    """
+    name = plan["name"]
+    binary = plan["binary"]
+
+    if os.path.exists(binary):
+        return True
+
+    if not os.path.isdir("fastbuild/pch"):
+        os.makedirs("fastbuild/pch")
+
+    prefix = open(name, "w")
+    for header in plan["headers"]:
+        prefix.write("#include \"" + os.path.realpath(pathFromRoot(header)) + "\"\n")
+    prefix.close()
+
+    temporary = binary + "." + str(os.getpid()) + ".tmp"
+    with traceSpan("precompile " + name, "compile", {"headers" : plan["headers"]}):
+        (ret, wall, user, system, rss) = callWithRusage(compiler + " " + params + " -x " + plan["language"] + " " + name + " -o " + temporary)
+    if ret != 0:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        return False
+
+    os.replace(temporary, binary)
+    recordMetrics("compile", "pch:" + name, wall, user, system, rss)
+    return True
+
+
+def planPrecompiledHeaders(cfg, finalfiles, finaldependency):
+    """Selects precompiled header for every macrotarget and sources which use it, 
+    before object keys are calculated, as arguments and key of precompiled header 
+    are part of object keys of its users. A source uses the precompiled header only 
+    when its first directives include all of its headers, in the same order and 
+    with nothing before them. Precompiled header costs about one compile, it is 
+    planned only if it is used by two sources.
+    """
+    precompiledHeaders.clear()
+    precompiledClosures.clear()
+    precompiledKeys.clear()
+    precompiledPlans.clear()
+
+    if (not "precompiled_headers" in cfg.keys()) or (not cfg["precompiled_headers"]):
+        return
+
+    compiler = cfg["compiler"]
+    threshold = 0.5
+    if "pch_threshold" in cfg.keys():
+        threshold = cfg["pch_threshold"]
+    prefixHeader = None
+    if ("pch_header" in cfg.keys()) and (cfg["pch_header"] != ""):
+        prefixHeader = pathToRoot(cfg["pch_header"])
+
+    for mt in finalfiles:
+        groups = dict()
+        for fn in finalfiles[mt]:
+            language = headerLanguage(compiler, fn)
+            groups.update({language : groups.get(language, list()) + [fn]})
+
+        for language in groups:
+            sources = groups[language]
+            if prefixHeader != None:
+                headers = [prefixHeader]
+            else:
+                headers = selectPrecompiledHeaders(sources, finaldependency, threshold)
+            if len(headers) == 0:
+                continue
+
+            users = [fn for fn in sources if leadingIncludes(fn)[0 : len(headers)] == headers]
+            if len(users) < 2:
+                continue
+
+            plan = precompiledHeaderPlan(compiler, headers, language)
+            if plan == None:
+                continue
+            plan.update({"macrotarget" : mt, "users" : users})
+            precompiledPlans.append(plan)
+            storeKeysInUse.add(plan["key"])
+            for fn in users:
+                precompiledHeaders.update({fn : plan["arguments"]})
+                precompiledClosures.update({fn : plan["closure"]})
+                precompiledKeys.update({fn : plan["key"]})
+
+
+def preparePrecompiledHeaders(buildlist, cfg, finaldependency):
+    """Builds planned precompiled headers used by sources to compile. Users of 
+    precompiled header which failed to compile are compiled without it, under 
+    object keys calculated without it.
+    """
+    compiler = cfg["compiler"]
+    params = cfg["compiler_params"] + " " + cfg["linker_params"]
+    pending = set(buildlist)
+
+    for plan in precompiledPlans:
+        users = plan["users"]
+        if len([fn for fn in users if fn in pending]) == 0:
+            continue
+
+        if not buildPrecompiledHeader(compiler, params, plan):
+            fastprint("Precompiled header of " + plan["macrotarget"] + " failed to compile, compiling without it", level=2)
+            for fn in users:
+                del precompiledHeaders[fn]
+                del precompiledClosures[fn]
+                del precompiledKeys[fn]
+                objectKeys.update({fn : calculateObjectKey(fn, finaldependency.dependenciesOf(fn))})
+                buildState["objects"].update({fn : objectKeys[fn]})
+            continue
+
+        fastprint("Precompiled header of " + plan["macrotarget"] + ": " + str(len(plan["headers"])) + " headers, used by " 
+            + str(len(users)) + " sources")
+
+
+def runBuilders(jobQueue, jobsCount, slots, compiler, cparams, lparams):
+    """Runs builder for every slot (local thread or remote worker slot), all of them 
+    take jobs from the shared queue.
+    """
+    if(len(slots) == 1):
+        microtargetBuilder(jobQueue, compiler, cparams, lparams, 0)
+    elif(jobsCount > 0):
+        remoteSlots = ""
+        if len(slots) > threadLimit:
+            remoteSlots = " (" + str(len(slots) - threadLimit) + " remote slots)"
+        fastprint("Compiling microtargets in up to " + str(len(slots)) + " threads" + remoteSlots)
+        threadList = list()
+        try:
+            for thr in range(min(len(slots), jobsCount)):
+                laneName = "compile #" + str(thr)
+                if slots[thr] != None:
+                    laneName = "worker " + slots[thr].address + " #" + str(thr)
+                t = threading.Thread(target=microtargetBuilder, args=(jobQueue, compiler, cparams, lparams, thr, slots[thr]), name=laneName)
+                t.start()
+                threadList.append(t)
+        finally:
+            for oneThread in threadList:
+                oneThread.join()
+
+
+def compileMicrotargets(buildlist, cfg, finalfiles, finaldependency):
+    """Compiles microtargets of the build list in up to threadLimit threads. 
+    Sets failmarker if some of them failed to compile.
+    """
+    compiler = cfg["compiler"]
+    cparams = cfg["compiler_params"]
+    lparams = cfg["linker_params"]
+
+    if (len(buildlist) == 0):
+        fastprint("Nothing to compile.", level=1)
+    else:
+        preparePrecompiledHeaders(buildlist, cfg, finaldependency)
+
+    jobQueue = scheduleBuildList(buildlist, finaldependency)
+    slots = prepareCompileSlots(cfg)
+
+    #multithreading compilation, threads take jobs from shared queue
+    buildCancelled.clear()
+    try:
+        runBuilders(jobQueue, len(buildlist), slots, compiler, cparams, lparams)
+    except KeyboardInterrupt:
+        buildCancelled.set()
+        terminateChildren()
+        raise
+
+    reportCompileResults(jobQueue, finaldependency)
+
+
+def prepareCompileSlots(cfg):
+    """Sets up admission control by limits of config and returns list of compile 
+    slots: None for local thread or remote worker for its slot.
+    """
+    global admission
+    memoryLimit = 90
+    if "memory_limit" in cfg.keys():
+        memoryLimit = cfg["memory_limit"]
+    loadLimit = 0
+    if "load_limit" in cfg.keys():
+        loadLimit = cfg["load_limit"]
+    admission = admissionControl(memoryLimit, loadLimit)
+
+    #local and remote slots interleaved, so short build lists are spread over all workers
+    lanes = [[None] * threadLimit]
+    if "workers" in cfg.keys():
+        for entry in cfg["workers"]:
+            worker = remoteWorker(entry["address"], entry.get("slots", 1))
+            lanes.append([worker] * worker.slots)
+    slots = list()
+    for i in range(max(len(lane) for lane in lanes)):
+        for lane in lanes:
+            if i < len(lane):
+                slots.append(lane[i])
+    return slots
+
+
+def reportCompileResults(jobQueue, finaldependency):
+    """Reports jobs not compiled after an error and held back jobs, and feeds 
+    dependencies harvested from depfiles into the dependency graph.
+    """
+    if buildCancelled.is_set() and (jobQueue.qsize() > 0):
+        fastprint(str(jobQueue.qsize()) + " microtargets not compiled after the first error "
+            + "(use --keep-going to compile all of them).", level=2)
+
+    if admission.heldBack > 0:
+        fastprint("Admission control: " + str(admission.heldBack) + " compiles held back by memory or load limits.")
+
+    for target in harvestedDependencies:
+        finaldependency.addSource(target, harvestedDependencies[target])
+    if len(harvestedDependencies) > 0:
+        fastprint("Compiler dependencies: " + str(len(harvestedDependencies)) + " sources updated from depfiles.")
+
+
+def pipelineEnabled(cfg):
+    """Checks if the build can run as pipeline ("pipeline" in config). Unity build and 
+    precompiled headers need the whole dependency graph before the first compile, 
+    so they use the steps one by one.
+    """
+    if (not "pipeline" in cfg.keys()) or (not cfg["pipeline"]) or treeOut:
+        return False
+    for option in ["unity_build", "precompiled_headers"]:
+        if (option in cfg.keys()) and cfg[option]:
+            fastprint("Pipelined build is not used with \"" + option + "\", building step by step", level=1)
+            return False
+    return True
 
-        if not (resolvedDependency in deplist):
-            if treeOut:
-                i = 0
-                fastprint(" ", fastend="")
-                while i < deep:
-                    fastprint("--", fastend="") 
-                    i = i + 1   
-                fastprint(">  " + resolvedDependency) #!
-                
-            deplist.append(resolvedDependency)
-            
-            ndp = deep + 1
-            findDependeciesInFile(dependency, ndp, recursionThreshold, deplist)     
-    
-    #dump tree only for 1-st range files
-    if deep == 1:
-        if (not os.path.isdir("fastbuild")):
-            os.makedirs("fastbuild")
-        pregenerationDumpFilename = "fastbuild/" + hashlib.md5(open(filename, 'rb').read()).hexdigest() + ".fasttree"
-        usedFasttreeFilenames.append(pregenerationDumpFilename)
-        pdfile = open(pregenerationDumpFilename, "w")
-        pdfile.write(json.dumps(deplist))
-        pdfile.close()
 
-    return deplist  
+def queueIfDirty(source, jobQueue, defaultCost):
+    """Pipeline stage: resolves dependencies of the source and its object key, and 
+    queues it for compilation at once if the object with this key was not built 
+    before. Returns dependencies and True if the dependency tree was restored.
+    """
+    if pipelineStopped.is_set():
+        return None
 
+    (deps, restored) = resolveSourceDependencies(source)
+    key = calculateObjectKey(source, deps)
+    with buildMetricsLock:
+        objectKeys.update({source : key})
 
-def getConfig():
-    """Reads the configuration file and converts it from the json format to a 
-    dictionary that stores the build parameters of the current project. Recommendations for 
-    filling the configuration file can be found in the Readme or you can study the sample file
+    if rebuildall:
+        reason = "rebuildall"
+    elif not objectAvailable(objectPath(source)):
+        reason = "new object"
+    else:
+        return deps, restored
+
+    cost = lastCompileTime(source)
+    if cost == None:
+        cost = defaultCost
+    with buildMetricsLock:
+        jobCosts.update({source : cost})
+        buildProgress["total"] = buildProgress["total"] + 1
+    with printLock:
+        fastprint("Adding file: " + source + " [" + reason + "]")
+    jobQueue.put(source)
+    return deps, restored
+
+
+def pipelineProducer(cfg, jobQueue, finaldependency, result):
+    """Pipeline producer thread: resolves file lists of macrotargets and scans their 
+    sources as soon as each list is ready, in up to threadLimit threads. Dependency 
+    graph is filled in order of file list when all sources are scanned.
     """
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
     try:
-        f = open(configFileName, 'r')
-        conftxt = f.read()
-        f.close()       
-    except IOError:
-        sys.exit("Error while open file " + configFileName + "!")
+        #expected time of jobs without history, heuristic can not be scaled before sources are scanned
+        known = [history[-1][0] for history in buildMetrics["compile"].values() if len(history) > 0]
+        defaultCost = 1.0
+        if len(known) > 0:
+            defaultCost = median(known)
+
+        finalfiles = dict()
+        scans = dict()
+        with ThreadPoolExecutor(max_workers=max(threadLimit, 4), thread_name_prefix="glob") as globPool:
+            with ThreadPoolExecutor(max_workers=threadLimit, thread_name_prefix="scan") as scanPool:
+                resolving = dict()
+                for macrotarget in cfg["macrotargets"]:
+                    future = globPool.submit(resolveMacrotargetFiles, macrotargetPatterns(cfg["macrotargets"][macrotarget]))
+                    resolving.update({future : macrotarget})
+
+                for future in as_completed(resolving):
+                    macrotarget = resolving[future]
+                    (src, emptyPatterns) = future.result()
+                    for pattern in emptyPatterns:
+                        fastprint(bgcolors.WARNING + "Warning: \"" + pattern + "\" of macrotarget \"" + macrotarget 
+                            + "\" matches no files." + bgcolors.ENDC, level=1)
+                    finalfiles.update({macrotarget : src})
+                    for fn in src:
+                        if fn not in scans:
+                            scans.update({fn : scanPool.submit(queueIfDirty, fn, jobQueue, defaultCost)})
+
+                for fn in scans:
+                    scans.update({fn : scans[fn].result()})
+
+        #macrotargets in config order, like in step by step build
+        result.update({"finalfiles" : dict((mt, finalfiles[mt]) for mt in cfg["macrotargets"])})
+        if pipelineStopped.is_set():
+            return
+
+        restoredNodesCount = 0
+        for fn in scans:
+            (deps, restored) = scans[fn]
+            if restored:
+                restoredNodesCount = restoredNodesCount + 1
+            finaldependency.addSource(fn, deps)
+        result.update({"restored" : restoredNodesCount, "scanned" : len(scans) - restoredNodesCount})
+    except BaseException as e:
+        result.update({"error" : e})
+        buildCancelled.set()
+    finally:
+        sourcesPending.clear()
+
+
+def pipelinedBuild(cfg):
+    """Steps 1-4 as pipeline: every source is queued for compilation as soon as it is 
+    scanned and found dirty (no object with its key), while other file lists are 
+    still resolved and other sources are scanned, so compiler slots are busy from 
+    the start of a cold build. Returns dependency graph of the build.
+    """
+    global repositoryRoot
+    repositoryRoot = findRepositoryRoot()
+    rootPathsCache.clear()
 
-    #print(conftxt)
+    global relativeToRoot
+    relativeToRoot = os.path.relpath(os.path.realpath(repositoryRoot), os.path.realpath("."))
 
-    try:
-        configObject = json.loads(conftxt)
-    except json.decoder.JSONDecodeError:
-        sys.exit("config file is incorrect!")
+    loadGitState()
 
-    global rebuildall
+    compiler = cfg["compiler"]
+    cparams = cfg["compiler_params"]
+    lparams = cfg["linker_params"]
 
-    if(os.path.isdir("fastbuild")):
-        try:
-            verfile = open("fastbuild/repversion.txt", "r")
-            ver = verfile.read()
-        except IOError:
-            ver = "oldversion"
+    setObjectKeyPrefix(getCompilerIdentity(compiler), cparams, lparams)
+    objectKeys.clear()
+    unityBatches.clear()
+    unityObjects.clear()
+    precompiledHeaders.clear()
+    precompiledClosures.clear()
+    precompiledKeys.clear()
+    precompiledPlans.clear()
+    jobCosts.clear()
+    buildProgress.update({"done" : 0, "total" : 0, "estimatedDone" : 0.0, "start" : time.time()})
+
+    os.makedirs("fastbuild/objects", exist_ok=True)
+
+    jobQueue = queue.Queue()
+    slots = prepareCompileSlots(cfg)
+    finaldependency = dependencyIndex()
+    result = dict()
+
+    buildCancelled.clear()
+    pipelineStopped.clear()
+    sourcesPending.set()
+    producer = threading.Thread(target=pipelineProducer, args=(cfg, jobQueue, finaldependency, result), name="pipeline", daemon=True)
+    producer.start()
+    try:
+        runBuilders(jobQueue, len(slots), slots, compiler, cparams, lparams)
+        producer.join()
+    except KeyboardInterrupt:
+        pipelineStopped.set()
+        buildCancelled.set()
+        terminateChildren()
+        raise
+
+    if "error" in result:
+        raise result["error"]
+
+    finalfiles = result["finalfiles"]
+    buildContext.update({"finalfiles" : finalfiles, "finaldependency" : finaldependency})
+    saveGlobCache()
+    saveIncludesCache(finaldependency)
+
+    printDependencyStats(len(finaldependency.sourcePaths()), result["restored"], result["scanned"])
+    reportCompileResults(jobQueue, finaldependency)
+
+    buildState.update({"objects" : dict(objectKeys)})
+    fastprint("Fingerprints: " + str(gitBlobHits) + " files by git blob id, " + str(fingerprintHits) 
+        + " files unchanged by stat, " + str(fingerprintReads) + " files hashed.")
+    if buildProgress["total"] == 0:
+        fastprint("Already up-to-date or no changes detected.", level=1)
+    else:
+        fastprint("Done!", level=1)
 
-        if ver != verstring:
-            rebuildall = True
-            fastprint("Your repository generated by older or newer version of fastbuild. Rebuildall required.")
-            input("Press Enter to continue...")
+    return finaldependency
 
-        try:
-            configfile = open("fastbuild/configname.txt", "r")
-            configname = configfile.read()
-        except IOError:
-            configname = "oldversion"
 
-        if ((configname != configFileName) and not rebuildall):
-            rebuildall = True
-            fastprint("Fastbuild detected that you are mixing different configurations. Rebuildall required.")
-            input("Press Enter to continue...")
+def prelinkMacrotarget(compiler, mt, objects, mode):
+    """Pre-links objects of macrotarget into one static archive ("archive") or 
+    relocatable object ("relocatable"). Output is named by key of its members, 
+    so it is built again only when one of them changes. Returns path or None if failed.
+    """
+    key = hashlib.md5((mode + "\n" + "\n".join(objects)).encode(systemEncoding)).hexdigest()
+    if mode == "archive":
+        output = "fastbuild/objects/" + key + ".a"
+    else:
+        output = "fastbuild/objects/" + key + ".r.o"
+
+    storeKeysInUse.add(key)
+    if os.path.exists(output):
+        fastprint("[prelink] " + mt + " [reused, " + str(len(objects)) + " objects]")
+        return output
+
+    name = "".join(c if (c.isalnum() or c in "-_") else "_" for c in mt)
+    rspname = "fastbuild/prelink-" + name + ".rsp"
+    rspfile = open(rspname, "w")
+    rspfile.write("\n".join(objects) + "\n")
+    rspfile.close()
+
+    tmpname = output + "." + str(os.getpid()) + ".tmp"
+    if mode == "archive":
+        prelinkShell = "ar rcs " + shlex.quote(tmpname) + " @" + rspname
+    else:
+        prelinkShell = compiler + " -r -nostdlib -o " + shlex.quote(tmpname) + " @" + rspname
 
-        wv = open("fastbuild/repversion.txt", "w")
-        wv.write(verstring)
-        wv.close()
-        wc = open("fastbuild/configname.txt", "w")
-        wc.write(configFileName)
-        wc.close()
+    with traceSpan("prelink " + mt, "link", {"objects" : len(objects)}):
+        (ret, wall, user, system, rss) = callWithRusage(prelinkShell)
+    if ret != 0:
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+        fastprint("[prelink] " + mt + " [failed]")
+        return None
 
-    return configObject
+    os.replace(tmpname, output)
+    recordMetrics("link", "prelink:" + mt, wall, user, system, rss)
+    fastprint("[prelink] " + mt + " [" + str(len(objects)) + " objects in " + str(round(wall, 2)) + " seconds]")
+    return output
 
 
-def checksumModificatedSinceLastFastbuild(fname, oldchk):
-    """Determines whether the checksum of the file has changed since the 
-    last time the hash table was saved to the disk.
+def linkSignature(compiler, lparams, outfile, linkobjs):
+    """Returns signature of link inputs. Objects are named by content keys, 
+    so their paths identify their contents.
     """
-    #pprint.pprint(oldchk)
-    if(fname not in oldchk.keys()):
-        return True
+    signature = getCompilerIdentity(compiler) + "\n" + lparams + "\n" + outfile + "\n" + "\n".join(linkobjs)
+    return hashlib.md5(signature.encode(systemEncoding)).hexdigest()
 
-    if rebuildall:
-        return True
 
-    checksumNew = hashlib.md5(open(fname, 'rb').read()).hexdigest()
-    checksumOld = oldchk[fname]
-    if checksumNew == checksumOld:
-        return False
-    else:
-        return True
+def outputSignature(outfile):
+    """Returns stat signature of linked output file or None if it does not exist"""
+    try:
+        st = os.stat(outfile)
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime_ns]
 
 
-def getModificatedByGit(correctEndings, untrackedAction, filestree, pollHeaders):
-    """With the repository data, git determines the modification of 
-    files in the file tree with the specified extensions. For files that are not 
-    specified in git, the modified function attempts to determine the fact of the 
-    change using a hash table.
+def buildProducts(cfg):
+    """Returns build products of config: macrotargets described by objects with "type" 
+    (static, shared or executable) -> type, output, dependencies and linker parameters. 
+    Exits if some product is incorrect or dependencies form a cycle.
     """
-    gitfiles = list(Popen("git status --porcelain", shell=True, stdin=PIPE, stdout=PIPE).stdout.read().split(b"\n"))
-    try:
-        oldchecksums = json.loads(open("fastbuild/repository.md5", 'r').read())
-    except IOError:
-        oldchecksums = dict()
+    products = dict()
+    for mt in cfg["macrotargets"]:
+        entry = cfg["macrotargets"][mt]
+        if (not isinstance(entry, dict)) or ("type" not in entry):
+            continue
+        kind = entry["type"]
+        if kind not in productTypes:
+            sys.exit("Unknown type of macrotarget \"" + mt + "\": " + str(kind) + " (supported: \"static\", \"shared\", \"executable\")")
+        output = entry.get("output", productTypes[kind].replace("NAME", mt))
+        products.update({mt : {"type" : kind, "output" : output, "depends" : entry.get("depends", list()),
+            "linker_params" : entry.get("linker_params", "")}})
+
+    for mt in products:
+        for dep in products[mt]["depends"]:
+            if dep not in products:
+                sys.exit("Macrotarget \"" + mt + "\" depends on \"" + dep + "\", which is not a library or executable!")
+
+    #depth first search, product on the stack is reached again only through a cycle
+    state = dict()
+    def visit(mt, stack):
+        if state.get(mt) == "done":
+            return
+        if state.get(mt) == "visiting":
+            sys.exit("Dependencies of macrotargets form a cycle: " + " -> ".join(stack + [mt]))
+        state.update({mt : "visiting"})
+        for dep in products[mt]["depends"]:
+            visit(dep, stack + [mt])
+        state.update({mt : "done"})
+    for mt in products:
+        visit(mt, list())
+
+    return products
+
+
+def productLibraries(products, mt):
+    """Returns libraries linked into the product, dependent libraries first. Static 
+    libraries under a shared library are already linked into it and are skipped.
+    """
+    libraries = list()
+    def visit(name, underShared):
+        for dep in products[name]["depends"]:
+            kind = products[dep]["type"]
+            if (kind == "static") and underShared:
+                continue
+            if (kind != "executable") and (products[dep]["output"] in libraries):
+                libraries.remove(products[dep]["output"])
+            if kind != "executable":
+                libraries.append(products[dep]["output"])
+            visit(dep, underShared or (kind == "shared"))
+    visit(mt, False)
+    return libraries
+
+
+def linkProduct(compiler, name, kind, output, linkobjs, libraries, lparams, inputSignatures):
+    """Links objects and libraries into output: static library made by ar, shared 
+    library or executable. Link is skipped when inputs (and signatures of libraries 
+    linked in) are the same as in last successful link and output is not changed. 
+    Returns signature of the product, or None if linking failed.
+    """
+    signatureParams = lparams
+    if name != None:
+        signatureParams = kind + "\n" + lparams
+    signature = linkSignature(compiler, signatureParams, output, linkobjs + libraries + inputSignatures)
+    with buildMetricsLock:
+        last = buildState["meta"].get("links", dict()).get(output)
+    if (not rebuildall) and (last != None) and (last["signature"] == signature) and (last["output"] == outputSignature(output)):
+        with printLock:
+            fastprint("["+compiler+"] Linking " + output + " [skipped, inputs not changed]")
+        return signature
+
+    #final output of config keeps its response file name
+    rspname = "fastbuild/link.rsp"
+    if name != None:
+        rspname = "fastbuild/link-" + "".join(c if (c.isalnum() or c in "-_") else "_" for c in name) + ".rsp"
+    rspfile = open(rspname, "w")
+    rspfile.write("\n".join(linkobjs) + "\n")
+    rspfile.close()
+
+    target = output
+    if kind == "static":
+        #ar adds members to existing archive, so archive is made anew and replaced
+        target = output + "." + str(os.getpid()) + ".tmp"
+        linkerShell = "ar rcs " + shlex.quote(target) + " @" + rspname
+    elif kind == "shared":
+        linkerShell = compiler + " -shared @" + rspname + " " + " ".join(shlex.quote(lib) for lib in libraries) + " -o " + shlex.quote(output) + " " + lparams
+    elif name != None:
+        linkerShell = compiler + " @" + rspname + " " + " ".join(shlex.quote(lib) for lib in libraries) + " -o " + shlex.quote(output) + " " + lparams
+    else:
+        linkerShell = compiler + " @" + rspname + " -o " + output + " " + lparams
 
-    toprocessing = list()
+    if os.path.dirname(output) != "":
+        os.makedirs(os.path.dirname(output), exist_ok=True)
 
-    #M -> modifing -> rebuild
-    #A -> new file -> rebuild
-    #D -> deleted -> ignore
-    #R -> renamed -> rebuild
-    #C -> copied -> rebuild
-    #?? -> untracked -> ask user
+    captured = list()
+    with traceSpan("link " + output, "link", {"objects" : len(linkobjs), "libraries" : len(libraries)}):
+        (ret, wall, user, system, rss) = callWithRusage(linkerShell, captured)
 
-    for candidate in gitfiles:
-        for currentEnding in correctEndings:
-            cnt = len(currentEnding)
-            candidateStr = str(candidate.decode(systemEncoding))
-            start = candidateStr[1:2]
-            end = candidateStr[-1*cnt:]
-            candidateName = candidateStr[3:]
+    with buildMetricsLock:
+        links = dict(buildState["meta"].get("links", dict()))
+        if ret != 0:
+            if output in links:
+                del links[output]
+        else:
+            if target != output:
+                os.replace(target, output)
+            links.update({output : {"signature" : signature, "output" : outputSignature(output)}})
+        buildState["meta"].update({"links" : links})
+
+    if ret != 0:
+        if (target != output) and os.path.exists(target):
+            os.remove(target)
+        status = "[failed]"
+    else:
+        recordMetrics("link", output, wall, user, system, rss)
+        status = "[Successful in " + str(round(wall, 2)) + " seconds]"
+
+    with printLock:
+        fastprint("["+compiler+"] Linking " + output + " " + status)
+        if len(captured[0]) > 0:
+            sys.stdout.flush()
+            sys.stderr.write(captured[0].decode('utf-8', 'replace'))
+            sys.stderr.flush()
+
+    if ret != 0:
+        return None
+    return signature
+
+
+def linkObjects(cfg, finalfiles):
+    """Links build products: every macrotarget with "type" is linked into its own 
+    library or executable, objects of other macrotargets are linked into output file 
+    of config. Products are linked in order of their dependencies, independent ones 
+    concurrently in up to threadLimit threads; product whose dependency failed is 
+    not linked. Sets failmarker if linking failed.
+    """
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
-            if (end != currentEnding):
-                continue
+    global failmarker
 
-            if (start == "D"):
-                continue
+    compiler = cfg["compiler"]
+    lparams = cfg["linker_params"]
 
-            if (start == "?"):
-                if untrackedAction == "ignore":
-                    continue
-                #elif untrackedAction == "ask":
-                    #print("file \"" + candidateStr + "\"have untracked git status, it is not in git repository. \n\
-                    #If this is just a new file(s) in your project, please make \"git add [filename]\" to add them in your\n\
-                    #project repository as soon as possible.\n\
-                    #Also, you can set default action for untracked files by untrackedAction parameter in config (ask, accept or ignore)\n\
-                    #\n")
-                    #quest = "Add this file to build list?"
-                    #cho = query_yes_no(quest, default="no")
-                    #if not cho:
-                    #   continue
-
-            if len(relativeToRoot) > 0:
-                candidateName = relativeToRoot + "/" + candidateName
-
-            if(not checksumModificatedSinceLastFastbuild(candidateName, oldchecksums)):
-                continue
+    prelink = "none"
+    if "prelink" in cfg.keys():
+        prelink = cfg["prelink"]
+    if prelink not in ["none", "archive", "relocatable"]:
+        fastprint("Unknown prelink mode: " + str(prelink) + " (supported: \"none\", \"archive\", \"relocatable\")", level=2)
+        sys.exit(1)
 
-            fastprint("Adding file: " + candidateName + " [" + end + "/" + start + "/git]")
-            toprocessing.append(candidateName)
-            #print(start + b"//////" + end)
+    products = buildProducts(cfg)
 
-    # Search in hashes
+    #objects of current sources only, passed in response file to keep command line short
+    linkobjs = list()
+    productObjects = dict()
+    for mt in finalfiles:
+        mtobjs = list()
+        for fn in finalfiles[mt]:
+            if (linkedObjectPath(fn) not in linkobjs) and (linkedObjectPath(fn) not in mtobjs):
+                mtobjs.append(linkedObjectPath(fn))
+        if mt in products:
+            productObjects.update({mt : mtobjs})
+        elif (prelink != "none") and (len(mtobjs) > 1):
+            output = prelinkMacrotarget(compiler, mt, mtobjs, prelink)
+            if output == None:
+                failmarker = True
+                return
+            linkobjs.append(output)
+        else:
+            linkobjs.extend(mtobjs)
+
+    #objects of macrotargets without type form output file of config, as before products
+    jobs = dict()
+    for mt in products:
+        jobs.update({mt : (mt, products[mt]["type"], products[mt]["output"], productObjects.get(mt, list()), 
+            productLibraries(products, mt), (lparams + " " + products[mt]["linker_params"]).strip(), products[mt]["depends"])})
+    if len(products) < len(cfg["macrotargets"]):
+        jobs.update({None : (None, "executable", cfg["linker_output_file"], linkobjs, list(), lparams, list())})
+
+    signatures = dict()
+    failed = set()
+    with ThreadPoolExecutor(max_workers=threadLimit, thread_name_prefix="link") as pool:
+        running = dict()
+        while (len(jobs) > 0) or (len(running) > 0):
+            for name in list(jobs.keys()):
+                (mt, kind, output, objects, libraries, params, depends) = jobs[name]
+                if any((dep in failed) for dep in depends):
+                    fastprint("["+compiler+"] Linking " + output + " [skipped, dependency failed]")
+                    failed.add(name)
+                    del jobs[name]
+                elif all((dep in signatures) for dep in depends):
+                    inputSignatures = [signatures[dep] for dep in depends]
+                    running.update({pool.submit(linkProduct, compiler, mt, kind, output, objects, libraries, params, inputSignatures) : name})
+                    del jobs[name]
+            if len(running) == 0:
+                continue
 
-    for mt in filestree:
-        for files in filestree[mt]:
-            for source in files:
-                if pollHeaders:
-                    for headers in files[source]:
-                        if (len(relativeToRoot) > 0):
-                            header = relativeToRoot + "/" + headers
-                        else:
-                            header = headers
-                        if checksumModificatedSinceLastFastbuild(header, oldchecksums):
-                            if header not in toprocessing:
-                                for currentEnding in correctEndings:
-                                    cnt = len(currentEnding)
-                                    end = header[-1*cnt:]
-                                    if end == currentEnding:
-                                        toprocessing.append(header)
-                                        if not rebuildall:
-                                            fastprint("Adding file: " + header + " [" + end + "/md5]")
-                                        else:
-                                            fastprint("Adding file: " + header + " [" + end + "/rebuildall]")
+            done = wait(running, return_when=FIRST_COMPLETED)[0]
+            for future in done:
+                name = running.pop(future)
+                signature = future.result()
+                if signature == None:
+                    failed.add(name)
                 else:
-                    if checksumModificatedSinceLastFastbuild(source, oldchecksums):
-                        if source not in toprocessing:
-                            for currentEnding in correctEndings:
-                                cnt = len(currentEnding)
-                                end = source[-1*cnt:]
-                                if end == currentEnding:
-                                    toprocessing.append(source)
-                                    if not rebuildall:
-                                        fastprint("Adding file: " + source + " [" + end + "/md5]")
-                                    else:
-                                        fastprint("Adding file: " + source + " [" + end + "/rebuildall]")                                   
+                    signatures.update({name : signature})
 
-    return toprocessing
+    if len(failed) > 0:
+        failmarker = True
+    else:
+        fastprint("Done!", level=1)
 
 
+def runPostprocessing(cfg):
+    """Runs postprocessing shell commands of config"""
+    if ("postprocessing_shell" in cfg.keys()) and (cfg["postprocessing_shell"] != ""):
+        if not failmarker:
+            call(cfg["postprocessing_shell"], shell=True)
+        else:
+            if cfg["postprocessing_if_failed"]:
+                call(cfg["postprocessing_shell"], shell=True)
+            else:
+                fastprint("Postprocessing disabled on fails by config parameter", level=1)
+    else:
+        fastprint("Postprocessing disabled", level=1)
 
-def selectDependecies(deps, headers):
-    """Finds which source files depend on the changed header files. 
-    Forms and returns a list of these dependencies.
-    """
-    sourcesDependence = list()
 
-    for macrotarget in deps:
-        for sourcelst in deps[macrotarget]:
-            for source in sourcelst:
-                for sourcedeps in sourcelst[source]:
-                    for header in headers:
-                        if (len(relativeToRoot) > 0):
-                            depheader = relativeToRoot + "/" + sourcedeps
-                        else:
-                            depheader = sourcedeps
-                        #fastprint("comparing " + header + " and " + depheader + " (src = " + source + ") ")
-                        if(header == depheader):
-                            sourcesDependence.append(source)
-                            #fastprint("--> Adding file: " + source + " [dependency of \""+header+"\"]")
+class inotifyWatcher:
+    """Watches directories for changes of their entries using Linux inotify (called through ctypes)"""
+    IN_MODIFY = 0x2
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_DELETE_SELF = 0x400
+    IN_MOVE_SELF = 0x800
+    IN_IGNORED = 0x8000
+
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+
+        libcName = ctypes.util.find_library("c")
+        if libcName == None:
+            raise OSError("libc not found")
+        self.libc = ctypes.CDLL(libcName, use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.directories = dict()
+        self.watched = set()
+
+    def watch(self, directory):
+        """Starts watching of the directory (if it is not watched yet)"""
+        if directory in self.watched:
+            return
+        mask = (self.IN_MODIFY | self.IN_ATTRIB | self.IN_CLOSE_WRITE | self.IN_MOVED_FROM | self.IN_MOVED_TO 
+            | self.IN_CREATE | self.IN_DELETE | self.IN_DELETE_SELF | self.IN_MOVE_SELF)
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), mask)
+        if wd >= 0:
+            self.directories.update({wd : directory})
+            self.watched.add(directory)
+
+    def read(self, timeout):
+        """Waits for events up to timeout seconds (forever if None), returns list of changed paths"""
+        import select
+        import struct
+
+        if len(select.select([self.fd], [], [], timeout)[0]) == 0:
+            return list()
+
+        data = os.read(self.fd, 65536)
+        changed = list()
+        offset = 0
+        while offset + 16 <= len(data):
+            (wd, mask, cookie, length) = struct.unpack_from("iIII", data, offset)
+            name = os.fsdecode(data[offset + 16 : offset + 16 + length].rstrip(b"\0"))
+            offset = offset + 16 + length
+            directory = self.directories.get(wd)
+            if directory == None:
+                continue
+            if mask & self.IN_IGNORED:
+                del self.directories[wd]
+                self.watched.discard(directory)
+                continue
+            if name != "":
+                changed.append(directory + "/" + name)
+            else:
+                changed.append(directory)
+        return changed
 
-    return sourcesDependence
 
+class pollingWatcher:
+    """Watches directories by comparing stat of their entries periodically,
+    used where inotify is not available.
+    """
+    def __init__(self):
+        self.snapshots = dict()
 
-def detectMissingObjFiles(filetree):
-    """Finds which object files are not in the cache to 
-    add them to the list for recompilation.
+    def snapshot(self, directory):
+        """Returns stat signatures of all entries of the directory"""
+        entries = dict()
+        try:
+            for entry in os.scandir(directory):
+                try:
+                    st = entry.stat()
+                    entries.update({entry.name : (st.st_size, st.st_mtime_ns, st.st_ino)})
+                except OSError:
+                    continue
+        except OSError:
+            pass
+        return entries
+
+    def watch(self, directory):
+        """Starts watching of the directory (if it is not watched yet)"""
+        if directory not in self.snapshots:
+            self.snapshots.update({directory : self.snapshot(directory)})
+
+    def read(self, timeout):
+        """Waits up to timeout seconds (forever if None), returns list of changed paths"""
+        waited = 0.0
+        while True:
+            changed = list()
+            for directory in self.snapshots:
+                old = self.snapshots[directory]
+                new = self.snapshot(directory)
+                for name in set(old.keys()) | set(new.keys()):
+                    if old.get(name) != new.get(name):
+                        changed.append(directory + "/" + name)
+                self.snapshots.update({directory : new})
+            if (len(changed) > 0) or ((timeout != None) and (waited >= timeout)):
+                return changed
+            time.sleep(0.5)
+            waited = waited + 0.5
+
+
+def watchedDirectories():
+    """Returns directories of config, sources, their dependencies and patterns of 
+    macrotargets, which are watched in watch mode
     """
-    
-    if(not os.path.isdir("fastbuild")):
-        fastprint("fastbuild work directory not found -> rebuild all targets", level=1)
-        os.makedirs("fastbuild")
+    dirs = set()
+    dirs.add(os.path.dirname(configFileName) or ".")
 
-    newObjFiles = list()
+    if "finalfiles" in buildContext:
+        for mt in buildContext["finalfiles"]:
+            for fn in buildContext["finalfiles"][mt]:
+                dirs.add(os.path.dirname(fn) or ".")
 
-    for mt in filetree:
-        for fn in filetree[mt]:
-            objFilename = hashlib.md5(fn.encode('utf-8')).hexdigest()
-            if(not os.path.exists("fastbuild/"+objFilename+".o")):
-                #fastprint("---> Adding file: " + fn + " [new object]")
-                newObjFiles.append(fn)
-            #print(mt + " -> " + fn + " -> " + )
-    return newObjFiles
+    if "finaldependency" in buildContext:
+        for dep in buildContext["finaldependency"].dependencyPaths():
+            dirs.add(os.path.dirname(pathFromRoot(dep)) or ".")
 
+    for entry in usedGlobCache.values():
+        for (directory, mtime) in entry["dirs"]:
+            if mtime != None:
+                dirs.add(directory)
 
-def generateChecksums(filetree):
-    """Generates a hash table with checksums for the project files so that 
-    the program can then find changes to the next build from the current one.
+    return dirs
+
+
+def watchRelevant(path):
+    """Checks if changed path can affect the build: config, sources and headers 
+    (by endings from config) and any other known dependency.
     """
+    if os.path.normpath(path) == os.path.normpath(configFileName):
+        return True
 
-    sums = dict()
+    if "cfg" not in buildContext:
+        return False
 
-    for macrotarget in filetree:
-        for sourcelst in filetree[macrotarget]:
-            for source in sourcelst:
-                if source not in sums.keys():
-                    checksum = hashlib.md5(open(source, 'rb').read()).hexdigest()
-                    sums.update({source : checksum})
-                for sourcedeps in sourcelst[source]:
-                    if (len(relativeToRoot) > 0):
-                        depheader = relativeToRoot + "/" + sourcedeps
-                    else:
-                        depheader = sourcedeps
-                    
-                    if depheader not in sums.keys():
-                        checksum = hashlib.md5(open(depheader, 'rb').read()).hexdigest()
-                        sums.update({depheader : checksum})
+    cfg = buildContext["cfg"]
+    for ending in cfg["sources_endings"] + cfg["headers_endings"]:
+        if path.endswith(ending):
+            return True
 
-    wt = open("fastbuild/repository.md5", "w")
-    wt.write(json.dumps(sums))
-    wt.close()
+    if "finaldependency" in buildContext:
+        rootPath = os.path.relpath(os.path.realpath(path), os.path.realpath(repositoryRoot))
+        return rootPath in buildContext["finaldependency"].ids
 
-    #pprint.pprint(sums)
+    return False
 
 
-def fileHasPregeneratedTree(filepath):
-    """Checks if file has a pregenerated dependency tree
-    If checksum of file is changed, dependecy tree is outdated and rebuild is needed
+def resetRunState():
+    """Clears per-run memo tables, so files are checked again in next watch iteration"""
+    global failmarker
+    failmarker = False
+    global outdatedTreesCount
+    outdatedTreesCount = 0
+    runChecksums.clear()
+    directIncludes.clear()
+    dependencyClosures.clear()
+    harvestedDependencies.clear()
+
+
+def watchRebuild(changedPaths):
+    """Incremental rebuild of watch mode: updates dependency graph and fingerprints 
+    in memory for changed files only, then compiles affected sources and relinks.
     """
-    try:
-        checksumNew = hashlib.md5(open(filepath, 'rb').read()).hexdigest()
-        filename = "fastbuild/" + checksumNew + ".fasttree"
-        readableTreeFile = open(filename)
-    except IOError:
-        return False
-    return True
+    cfg = buildContext["cfg"]
+    finaldependency = buildContext["finaldependency"]
+    oldfiles = buildContext["finalfiles"]
 
+    #only changed files are stated again, fingerprints of other files are kept for this run
+    global failmarker
+    failmarker = False
+    harvestedDependencies.clear()
+    directIncludes.clear()
+    dependencyClosures.clear()
+    for path in changedPaths:
+        if os.path.normpath(path) in runChecksums:
+            del runChecksums[os.path.normpath(path)]
+        gitDirtyPaths.add(pathToRoot(os.path.normpath(path)))
+
+    #glob cache makes this cheap, patterns are resolved again only in changed directories
+    (finalfiles, filescount) = resolveMacrotargets(cfg)
+    buildContext.update({"finalfiles" : finalfiles})
+
+    oldsources = set()
+    for mt in oldfiles:
+        oldsources.update(oldfiles[mt])
+    newsources = set()
+    for mt in finalfiles:
+        newsources.update(finalfiles[mt])
 
-def restorePregeneratedDependenciesForFile(filepath):
-    """Reads pregenerated dependency tree for specified file"""
-    try:
-        checksumNew = hashlib.md5(open(filepath, 'rb').read()).hexdigest()
-        filename = "fastbuild/" + checksumNew + ".fasttree"
-        usedFasttreeFilenames.append(filename)
-        readableTreeFile = open(filename)
-        deptxt = readableTreeFile.read()
-    except IOError:
-        fastprint("Error reading file " + filename + "!")
-        raise pregenerationError("File Error")
-    
-    try:
-        depobject = json.loads(deptxt)
-    except json.decoder.JSONDecodeError:
-        fastprint("json structure in file "+filename+" is incorrect!")    
-        raise pregenerationError("JSON Error")
-
-    return depobject
+    removed = oldsources - newsources
+    for source in removed:
+        finaldependency.removeSource(source)
+        if source in objectKeys:
+            del objectKeys[source]
 
+    changedRoot = set()
+    for path in changedPaths:
+        changedRoot.add(os.path.relpath(os.path.realpath(path), os.path.realpath(repositoryRoot)))
 
-def microtargetBuilder(localBuildlist, localCompiler, localCParams, localLParams, threadNumber):
-    """Builds specified range of microtargets in separate thread"""
-    for target in localBuildlist:
-        targetObjName = hashlib.md5(target.encode('utf-8')).hexdigest()
-        targetObjPath = "fastbuild/" + targetObjName + ".o"
-        compilerShell = localCompiler + " " + localCParams + " " + localLParams + " -c " + target +" -o " + targetObjPath
-        #fastprint(compilerShell)
-                
-        cstart = time.time()
-        ret = call(compilerShell, shell=True)
-        cend = time.time()
-        
-        if(ret != 0):
-            global failmarker
-            failmarker = True
-            fastprint("["+localCompiler+"] Compile " + target + " (object id: "+targetObjName+") " 
-                + "[failed] in thread #" + str(threadNumber))
+    affected = list()
+    for mt in finalfiles:
+        for fn in finalfiles[mt]:
+            if (fn not in oldsources) or (resolveRelativePath(fn) in changedRoot):
+                affected.append(fn)
+    for rootPath in changedRoot:
+        for source in finaldependency.dependentsOf(rootPath):
+            if (source in newsources) and (source not in affected):
+                affected.append(source)
+
+    fastprint("[watch] " + str(len(changedPaths)) + " files changed, " + str(len(affected)) + " sources affected, "
+        + str(len(removed)) + " sources removed.", level=1)
+
+    if (len(affected) == 0) and (len(removed) == 0):
+        return
+
+    for source in affected:
+        if compilerDependencies and fileHasPregeneratedTree(source):
+            deps = restorePregeneratedDependenciesForFile(source)
         else:
-            fastprint("["+localCompiler+"] Compile " + target + " (object id: "+targetObjName+") " 
-                + "[Successful in " + str(round(cend - cstart, 2)) + " seconds] in thread #" + str(threadNumber))
-
-
-def separateBuildLists(globalBuildlist, threads):
-    """Separates build list per different threads"""
-    listSize = int(len(globalBuildlist) / threads)
-    listOfLists = list()
-    tmpList = list()
-    itr = 0
-
-    if listSize == 0:
-        listOfLists.append(copy.deepcopy(globalBuildlist))
-        return listOfLists
-
-    #fastprint(str(len(globalBuildlist)) + " - all")
-    #fastprint(str(listSize) + " - one thread")
-
-    for oneTarget in globalBuildlist:
-        tmpList.append(oneTarget)
-        itr = itr + 1
-        if ((itr == listSize) and (len(listOfLists) < threads)):
-            copylist = list()
-            copylist = copy.deepcopy(tmpList)
-            listOfLists.append(copylist)
-            tmpList.clear()
-            itr = 0
-
-    itr = 0
-    for moduloTarget in tmpList:
-        listOfLists[itr].append(moduloTarget)
-        itr = itr + 1
-        if (itr == threads):
-            itr = 0
-    
+            deps = findDependeciesInFile(source, 1, recursionThreshold, list())
+        finaldependency.addSource(source, deps)
+        objectKeys.update({source : calculateObjectKey(source, deps)})
+
+    #in unity build any batch can lose or gain members, so all sources are checked
+    planUnityBatches(cfg, finalfiles, finaldependency)
+    candidates = affected
+    if len(unityBatches) > 0:
+        candidates = sorted(newsources)
+
+    buildlist = list()
+    for source in candidates:
+        if not objectAvailable(linkedObjectPath(source)):
+            buildlist.append(source)
+    buildlist = unityBuildList(buildlist)
+    buildState.update({"objects" : dict(objectKeys)})
+
+    compileMicrotargets(buildlist, cfg, finalfiles, finaldependency)
+    if failmarker:
+        fastprint("Some targets failed to compile. Waiting for fixes...", level=2)
+        return
 
-    #pprint.pprint(listOfLists, indent=4)
-    
-    return listOfLists
+    linkObjects(cfg, finalfiles)
+    if failmarker:
+        fastprint("Failed to link obj files. Waiting for fixes...", level=2)
+        return
+
+    generateChecksums(finaldependency)
+    runPostprocessing(cfg)
 
 
-def cleanupDependencyTrees(dependency):
-    """ cleans up dependency's fasttrees, to prevent nested includes problem
-    This trees will be generated on next fastbuild run
+def watchLoop():
+    """Watch mode: stays resident after the first build, waits for changes of sources, 
+    headers and config and rebuilds affected targets as soon as edits land. 
+    Change of config leads to full build.
     """
-    for dp in dependency:
-        try:
-            dpchecksum = hashlib.md5(open(dp, 'rb').read()).hexdigest()
-            dpname = "fastbuild/" + dpchecksum + ".fasttree"
-            os.remove(dpname)
-        except OSError:
-            continue
+    try:
+        watcher = inotifyWatcher()
+    except (OSError, AttributeError):
+        fastprint("inotify is not available, falling back to polling", level=1)
+        watcher = pollingWatcher()
+
+    try:
+        while True:
+            for directory in watchedDirectories():
+                watcher.watch(directory)
+
+            fastprint(bgcolors.BOLD + "\n[watch] Waiting for changes... (Ctrl+C to exit)" + bgcolors.ENDC, level=1)
+            changed = set()
+            while len(changed) == 0:
+                changed = set(path for path in watcher.read(None) if watchRelevant(path))
+
+            #editors write files in several steps, collect them into one rebuild
+            while True:
+                more = watcher.read(0.2)
+                if len(more) == 0:
+                    break
+                changed.update(path for path in more if watchRelevant(path))
+
+            start = time.time()
+            configChanged = any(os.path.normpath(path) == os.path.normpath(configFileName) for path in changed)
+            try:
+                if configChanged or ("finaldependency" not in buildContext):
+                    fastprint("[watch] Config changed, full build.", level=1)
+                    resetRunState()
+                    main()
+                else:
+                    watchRebuild(sorted(changed))
+            except SystemExit:
+                pass
+            finishSharedCache()
+            commitBuildState()
+            fastprint(bgcolors.BOLD + "[watch] Rebuilt in " + str(round(time.time() - start, 2)) + " seconds." + bgcolors.ENDC, level=1)
+    except KeyboardInterrupt:
+        fastprint("\n[watch] Stopped.", level=1)
+
 
 def main():
     """ main() function, consistently performs all the steps of the project's build porcess """
     fastprint(bgcolors.BOLD + bgcolors.UNDERLINE + "\nFastbuild - (c) by Motylenok \"muxamed666\" Mikhail\n" + bgcolors.ENDC)
 
+    traceStep("Step 0: Reading config")
     fastprint("Step 0: Reading Config: ", level=1)
     cfg = getConfig()
+    buildContext.clear()
+    buildContext.update({"cfg" : cfg})
+
+    global hashAlgorithm
+    if "hash_algorithm" in cfg.keys():
+        hashAlgorithm = cfg["hash_algorithm"]
+    openBuildState()
+
+    global compilerDependencies
+    if "compiler_dependencies" in cfg.keys():
+        compilerDependencies = cfg["compiler_dependencies"]
+    buildProducts(cfg)
+    openSharedCache(cfg)
+    #manifest is written again only if this build succeeds
+    if os.path.exists(manifestFileName):
+        os.remove(manifestFileName)
     fastprint("Done!", level=1)
 
+    if pipelineEnabled(cfg):
+        traceStep("Steps 1-4: Pipelined build")
+        fastprint("\nSteps 1-4: Resolving, scanning and compiling in pipeline: ", level=1)
+        finaldependency = pipelinedBuild(cfg)
+        finishBuild(cfg, finaldependency)
+        return
 
-    fastprint("\nStep 1: Building and polling file list: ", level=1)
 
-    finalfiles = dict()
-    filescount = 0
-    targetscount = len(cfg["macrotargets"])
-    j = 0
+    traceStep("Step 1: Building file list")
+    fastprint("\nStep 1: Building and polling file list: ", level=1)
 
-    for macrotarget in cfg["macrotargets"]:
-        #print("\nFiles for macrotarget \"" + macrotarget + "\": ")
-        #TODO: make visible
-        src = list()
-        for filelist in cfg["macrotargets"][macrotarget]:
-            for files in resolveFilesRegexp(filelist):
-                item = str(files.decode(systemEncoding))
-                if item != "":
-                    filescount = filescount + 1;
-                    src.append(item)
-                    #print("\t" + item)
-                    #TODO: make visible
-        j = j + 1
-        fastprint("[" + str(int(round((j / targetscount) * 100 ))) + "%] In Progress...", fastend="\r", level=1)
-        finalfiles.update({macrotarget: src})
+    (finalfiles, filescount) = resolveMacrotargets(cfg)
+    buildContext.update({"finalfiles" : finalfiles})
 
-    fastprint("[100%] Done!              ", level=1)
+    fastprint("File list: " + str(filescount) + " files, " + str(globCacheHits) + " patterns restored from cache, " 
+        + str(globCacheMisses) + " patterns resolved.")
     #fastprint(finalfiles)
 
 
+    traceCounter("files", {"files" : filescount, "globCacheHits" : globCacheHits, "globCacheMisses" : globCacheMisses})
+    traceStep("Step 2: Resolving dependencies")
     fastprint("\nStep 2: Resolving dependencies and building dependency tree: ", level=1)
 
-    global usedFasttreeFilenames
     global repositoryRoot
-    child = Popen("git rev-parse --show-toplevel", shell=True, stdin=PIPE, stdout=PIPE) 
-    repositoryRoot = str(list(child.stdout.read().split(b"\n"))[0].decode(systemEncoding))
+    repositoryRoot = findRepositoryRoot()
+    rootPathsCache.clear()
+
+    global relativeToRoot
+    relativeToRoot = os.path.relpath(os.path.realpath(repositoryRoot), os.path.realpath("."))
+
+    loadGitState()
 
-    finaldependency = dict()
+    finaldependency = dependencyIndex()
     i = 0
     restoredNodesCount = 0
     outdatedNodesCount = 0
 
-    for mt in finalfiles:
-        if treeOut:
+    if treeOut:
+        #tree is printed in order, so files are processed one by one
+        for mt in finalfiles:
             fastprint(bgcolors.HEADER + bgcolors.BOLD + "\n " + mt + " * * * : " + bgcolors.ENDC)
-        srcdps = list()
-        for fn in finalfiles.get(mt):
-            i = i + 1
-            if treeOut:
+            for fn in finalfiles.get(mt):
                 fastprint(bgcolors.GREEN + bgcolors.BOLD + "\n>>>> " + fn + bgcolors.ENDC)
-            if ((not fileHasPregeneratedTree(fn)) or treeOut or rebuildTree):
                 outdatedNodesCount = outdatedNodesCount + 1
-                if treeOut:
-                    fastprint("Tree node is out of date, rebuilding...")
+                fastprint("Tree node is out of date, rebuilding...")
                 deps = findDependeciesInFile(fn, 1, recursionThreshold, list())
-            else:
+                finaldependency.addSource(fn, deps)
+    else:
+        #sources are scanned in up to threadLimit threads, results are merged in order of file list
+        sources = list()
+        for mt in finalfiles:
+            for fn in finalfiles.get(mt):
+                if fn not in sources:
+                    sources.append(fn)
+
+        results = parallelMap(resolveSourceDependencies, sources)
+
+        for fn, (deps, restored) in zip(sources, results):
+            i = i + 1
+            if restored:
                 restoredNodesCount = restoredNodesCount + 1
-                if treeOut:
-                    fastprint("Tree generation not performed here, tree restored from cache...")
-                try:
-                    deps = restorePregeneratedDependenciesForFile(fn)
-                except pregenerationError:
-                    deps = findDependeciesInFile(fn, 1, recursionThreshold, list())
-            filedeps = dict({fn : deps})
-            srcdps.append(filedeps)
-            if not treeOut:
-                fastprint("[" + str(int(round( (i / filescount) * 100 ))) + "%] In Progress...", fastend="\r", level=1)
-        finaldependency.update({mt : srcdps})
+            else:
+                outdatedNodesCount = outdatedNodesCount + 1
+            finaldependency.addSource(fn, deps)
+            fastprint("[" + str(int(round( (i / filescount) * 100 ))) + "%] In Progress...", fastend="\r", level=1)
 
     fastprint("[100%] Done!              ", level=1)
     #pprint.pprint(finaldependency, indent=4)
 
-    #cleanup
-    deletedFiles = 0
-    listOfFiles = os.listdir('fastbuild/')  
-    clPattern = "*.fasttree"  
-    for clEntry in listOfFiles:  
-        if fnmatch.fnmatch(clEntry, clPattern):
-            clFilename = "fastbuild/"+clEntry
-            if clFilename not in usedFasttreeFilenames:
-                    os.remove(clFilename)
-                    deletedFiles = deletedFiles + 1
-
     if treeOut:
+        saveIncludesCache(finaldependency)
         sys.exit(0)
 
-    fastprint("\nDependency tree: "+str(filescount)+" nodes total, "+str(restoredNodesCount)
-        +" nodes restored, "+str(outdatedNodesCount)+" nodes out of date.")
-    fastprint("Dependency tree: "+str(len(usedFasttreeFilenames))+" nodes in use, "
-        +str(deletedFiles)+" nodes cleaned up.")
+    printDependencyStats(filescount, restoredNodesCount, outdatedNodesCount)
 
 
 
+    traceCounter("dependency trees", {"restored" : restoredNodesCount, "scanned" : outdatedNodesCount})
+    traceStep("Step 3: Calculating changes")
     fastprint("\nStep 3: Calculating changes: ", level=1)
 
-    global relativeToRoot
-    child = Popen("realpath --relative-to=. " + repositoryRoot, shell=True, stdin=PIPE, stdout=PIPE) 
-    relativeToRoot = str(list(child.stdout.read().split(b"\n"))[0].decode(systemEncoding))
+    compiler = cfg["compiler"]
+    cparams = cfg["compiler_params"]
+    lparams = cfg["linker_params"]
+
+    paths = list(finaldependency.sourcePaths())
+    for dep in finaldependency.dependencyPaths():
+        paths.append(pathFromRoot(dep))
+    hashFiles(paths)
+    saveIncludesCache(finaldependency)
+
+    setObjectKeyPrefix(getCompilerIdentity(compiler), cparams, lparams)
+    planPrecompiledHeaders(cfg, finalfiles, finaldependency)
+    with traceSpan("object keys", "hash"):
+        calculateObjectKeys(finalfiles, finaldependency)
+    planUnityBatches(cfg, finalfiles, finaldependency)
+    buildContext.update({"finaldependency" : finaldependency})
 
     sources = getModificatedByGit(cfg["sources_endings"], cfg["untracked_action"], finaldependency, False)
     headers = getModificatedByGit(cfg["headers_endings"], cfg["untracked_action"], finaldependency, True)
     dependn = selectDependecies(finaldependency, headers)
 
-    cleanupDependencyTrees(dependn)
-
     buildlist = sources
 
     for dep in dependn:
@@ -669,41 +4137,44 @@ def main():
             buildlist.append(obj)
             fastprint("Adding file: " + obj + " [new object]")
 
+    #changed files whose object with the same key was built before are not compiled again
+    cachedobjs = list()
+    for target in buildlist:
+        if target not in objectKeys:
+            fastprint("Skipping file: " + target + " [not in macrotargets]")
+            cachedobjs.append(target)
+        elif (not rebuildall) and (target not in newobjs):
+            fastprint("Reusing object: " + target + " [" + objectKeys[target] + "]")
+            cachedobjs.append(target)
+
+    for obj in cachedobjs:
+        buildlist.remove(obj)
+
+    buildlist = unityBuildList(buildlist)
+
+    buildState.update({"objects" : dict(objectKeys)})
+    fastprint("Fingerprints: " + str(gitBlobHits) + " files by git blob id, " + str(fingerprintHits) 
+        + " files unchanged by stat, " + str(fingerprintReads) + " files hashed.")
+
     if (len(buildlist) == 0):
         fastprint("Already up-to-date or no changes detected.", level=1)
     else:
         fastprint("Done!", level=1)
 
 
+    traceCounter("fingerprints", {"git" : gitBlobHits, "unchanged" : fingerprintHits, "hashed" : fingerprintReads, "toCompile" : len(buildlist)})
+    traceStep("Step 4: Compiling microtargets")
     fastprint("\nStep 4: Compiling microtargets: ", level=1)
-    compiler = cfg["compiler"]
-    cparams = cfg["compiler_params"]
-    lparams = cfg["linker_params"]
+    compileMicrotargets(buildlist, cfg, finalfiles, finaldependency)
 
-    if (len(buildlist) == 0):
-        fastprint("Nothing to compile.", level=1)
-
-    global failmarker
+    finishBuild(cfg, finaldependency)
 
-    threadList = list()
-
-    #multithreading compilation
-    if(threadLimit == 1):
-        microtargetBuilder(buildlist, compiler, cparams, lparams, 0)
-    else:
-        if(len(buildlist) > 0):
-            fastprint("Compiling microtargets in up to " + str(threadLimit) + " threads")
-            buildLists = separateBuildLists(buildlist, threadLimit)
-            thr = 0
-            for oneBuildList in buildLists:
-                t = threading.Thread(target=microtargetBuilder, args=(oneBuildList, compiler, cparams, lparams, thr))
-                t.start()
-                threadList.append(t)
-                thr = thr + 1
-            for oneThread in threadList:
-                oneThread.join()
-             
 
+def finishBuild(cfg, finaldependency):
+    """Steps 5 and 6: links objects, saves checksums and runs postprocessing, 
+    unless compiling or linking failed.
+    """
+    finalfiles = buildContext["finalfiles"]
 
     if failmarker:
         fastprint("Some targets failed to compile. Please fix errors, and run fastbuild again.", level=2)
@@ -711,21 +4182,9 @@ def main():
     
     #linking
 
+    traceStep("Step 5: Linking")
     fastprint("\nStep 5: Linking obj-files: ", level=1)
-    outfile = cfg["linker_output_file"]
-
-    fastprint("["+compiler+"] Linking " + outfile + " ", fastend="")
-    linkerShell = compiler + " fastbuild/*.o -o " + outfile + " " + lparams
-    #fastprint(linkerShell) 
-    lstart = time.time()
-    ret = call(linkerShell, shell=True)
-    lend = time.time()
-    if(ret != 0):
-        failmarker = True
-        fastprint("[failed]")
-    else:
-        fastprint("[Successful in " + str(round(lend - lstart, 2)) + " seconds]")
-        fastprint("Done!", level=1)
+    linkObjects(cfg, finalfiles)
 
     #call("pwd", shell=True)
 
@@ -734,21 +4193,17 @@ def main():
         sys.exit(0)
 
     if not failmarker: 
-        generateChecksums(finaldependency)
+        with traceSpan("checksums", "hash"):
+            generateChecksums(finaldependency)
+        cleanObjectStore(cfg)
 
 
+    traceStep("Step 6: Postprocessing")
     fastprint("\nStep 6: Running postprocessing shell: ", level=1)  
+    runPostprocessing(cfg)
 
-    if ("postprocessing_shell" in cfg.keys()) and (cfg["postprocessing_shell"] != ""):
-        if not failmarker:
-            call(cfg["postprocessing_shell"], shell=True)
-        else:
-            if cfg["postprocessing_if_failed"]:
-                call(cfg["postprocessing_shell"], shell=True)
-            else:
-                fastprint("Postprocessing disabled on fails by config parameter", level=1)
-    else:
-        fastprint("Postprocessing disabled", level=1)
+    if not watchMode:
+        writeManifest(cfg, finaldependency)
 
 
 if  __name__ ==  "__main__" :
@@ -763,8 +4218,17 @@ if  __name__ ==  "__main__" :
     parser.add_argument("-r", "--recmax", help="Maximum deep of dependencies tree (default: 24)", type=int)
     parser.add_argument("-u", "--updatetree", help="Force fastbuild to generate new dependency tree", action="store_true")
     parser.add_argument("-e", "--encode", help="Force strings encoding in this Python 3 format")
-    parser.add_argument("-p", "--threads", help="Number of threads (min 1, max 32, default 1)", type=int)
+    parser.add_argument("-p", "--threads", help="Number of threads, or \"auto\" to use all available CPUs (default 1)", type=str)
     parser.add_argument("-v", "--version", help="Display version string and exit", action="store_true")
+    parser.add_argument("--stats", help="Display slowest and regressed translation units and exit", action="store_true")
+    parser.add_argument("--cache-stats", help="Display statistics of shared cache and exit", action="store_true")
+    parser.add_argument("--worker", help="Run as compile worker listening on ADDRESS (host:port or unix:/path)", metavar="ADDRESS", type=str)
+    parser.add_argument("--slots", help="Number of parallel compiles of worker (default: number of CPUs)", type=int)
+    parser.add_argument("--trace", help="Write timeline of the build in Chrome trace event format to TRACE file", type=str)
+    failures = parser.add_mutually_exclusive_group()
+    failures.add_argument("--fail-fast", help="Terminate running compiles and stop at the first error", action="store_true")
+    failures.add_argument("-k", "--keep-going", help="Compile all microtargets even after errors", action="store_true")
+    parser.add_argument("-w", "--watch", help="Stay resident and rebuild on changes of sources, headers and config", action="store_true")
     args = parser.parse_args()
     
     if args.quiet:
@@ -792,10 +4256,12 @@ if  __name__ ==  "__main__" :
             recursionThreshold = args.recmax
 
     if args.threads:
-        if (args.threads < 1 or args.threads > 32):
-            sys.exit("Thread number must be in range from 1 to 32! (default: 1)")
+        if args.threads == "auto":
+            threadLimit = detectCpuCount()
+        elif (not args.threads.isdigit()) or (int(args.threads) < 1):
+            sys.exit("Thread number must be a positive number or \"auto\"! (default: 1)")
         else:
-            threadLimit = args.threads
+            threadLimit = int(args.threads)
 
     if args.encode:
         systemEncoding = args.encode
@@ -803,7 +4269,57 @@ if  __name__ ==  "__main__" :
     if args.version:
         sys.exit(verstring)
 
+    if args.stats or args.cache_stats or args.worker:
+        importBuildModules()
+
+    if args.stats:
+        printStatsReport()
+        sys.exit(0)
+
+    if args.cache_stats:
+        printCacheStats()
+        sys.exit(0)
+
+    if args.worker:
+        runWorker(args.worker, args.slots or os.cpu_count() or 1)
+        sys.exit(0)
+
+    if args.fail_fast:
+        failureMode = "fail-fast"
+
+    if args.keep_going:
+        failureMode = "keep-going"
+
+    if args.watch:
+        watchMode = True
+
+    if args.trace:
+        traceFileName = args.trace
+
+    #nothing changed since last successful build: done without starting any process
+    if (not rebuildall) and (not treeOut) and (not rebuildTree) and (not watchMode) and (traceFileName == None) and nullBuild():
+        fastprint("Fastbuild: already up-to-date, nothing changed since last build.", level=1)
+        sys.exit(0)
+
+    importBuildModules()
+    if traceFileName != None:
+        threading.current_thread().name = "main"
+
     start = time.time() 
-    main()
+    try:
+        if watchMode:
+            try:
+                main()
+            except SystemExit:
+                pass
+            finishSharedCache()
+            commitBuildState()
+            watchLoop()
+        else:
+            main()
+    finally:
+        finishSharedCache()
+        commitBuildState()
+        writeTrace()
     end = time.time()
     fastprint(bgcolors.BOLD + "\nFastbuild done in " + str(round(end - start, 2)) + " seconds. Thank you." + bgcolors.ENDC, level=1)
@@ -6,7 +6,20 @@ git pull origin master
 mkdir -p /usr/local/share/fastbuild
 cp -f fastbuild.py /usr/local/share/fastbuild/fastbuild.py
 chmod +x /usr/local/share/fastbuild/fastbuild.py
-ln -s -f /usr/local/share/fastbuild/fastbuild.py /usr/bin/fastbuild
+/usr/bin/python3 -m py_compile /usr/local/share/fastbuild/fastbuild.py
+
+# launcher runs fastbuild from bytecode compiled above, so it is not compiled on every start
+rm -f /usr/bin/fastbuild
+cat > /usr/bin/fastbuild <<'LAUNCHER'
+#!/usr/bin/python3
+import importlib.util
+import sys
+spec = importlib.util.spec_from_file_location("__main__", "/usr/local/share/fastbuild/fastbuild.py")
+module = importlib.util.module_from_spec(spec)
+sys.modules["__main__"] = module
+spec.loader.exec_module(module)
+LAUNCHER
+chmod +x /usr/bin/fastbuild
 
 echo ""
 echo "Done."